@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# 256M ROM Builder
+# Author: Lesserkuma (github.com/lesserkuma)
+#
+# Benchmark for both builders using a synthetic ROM corpus.
+# Each run is appended as one JSON line to the output file.
+
+import os, sys, io, time, json, random, shutil, tempfile, platform, datetime, argparse, contextlib, importlib
+
+# Configuration
+default_output_file = "benchmark.jsonl"
+rom_sizes = [ 0x8000, 0x10000, 0x20000, 0x40000, 0x80000, 0x100000, 0x200000, 0x400000, 0x800000 ]
+rom_size_weights = [ 6, 6, 6, 6, 5, 5, 3, 2, 1 ]
+mappers = [ (0x01, 0x03), (0x13, 0x13), (0x19, 0x1B) ] # MBC1, MBC3, MBC5 (without, with SRAM)
+build_phase_groups = {
+	"ingest":[ "discovery", "glyph rendering" ],
+	"placement":[ "SRAM placement", "non-SRAM placement", "optimal placement" ],
+	"checksum":[ "FixChecksums" ],
+	"menu":[ "menu patching" ],
+	"write":[ "output write" ],
+}
+subtitle_chars = "口袋妖怪水晶金银红蓝绿黄宝石火焰叶子钻石珍珠白黑心魂大冒险传说之王国"
+logo = bytearray([
+	0xCE, 0xED, 0x66, 0x66, 0xCC, 0x0D, 0x00, 0x0B, 0x03, 0x73, 0x00, 0x83, 0x00, 0x0C, 0x00, 0x0D,
+	0x00, 0x08, 0x11, 0x1F, 0x88, 0x89, 0x00, 0x0E, 0xDC, 0xCC, 0x6E, 0xE6, 0xDD, 0xDD, 0xD9, 0x99,
+	0xBB, 0xBB, 0x67, 0x63, 0x6E, 0x0E, 0xEC, 0xCC, 0xDD, 0xDC, 0x99, 0x9F, 0xBB, 0xB9, 0x33, 0x3E
+])
+
+################################
+
+def make_rom(file, size, title, mapper=mappers[2], sram=0, cgb=0x80, file_size=None, seed=0):
+	# Random ROM data with a valid header; `file_size` smaller than `size` makes a trimmed ROM
+	rng = random.Random(seed)
+	buffer = bytearray(rng.randbytes(size if file_size is None else file_size))
+	buffer[0x104:0x134] = logo
+	buffer[0x134:0x143] = title.encode("ascii")[:15].ljust(15, b"\x00")
+	buffer[0x143] = cgb
+	buffer[0x146] = 0
+	buffer[0x147] = mapper[1] if sram > 0 else mapper[0]
+	buffer[0x148] = rom_sizes.index(size)
+	buffer[0x149] = sram
+	checksum = 0
+	for i in range(0x134, 0x14D):
+		checksum = checksum - buffer[i] - 1
+	buffer[0x14D] = checksum & 0xFF
+	buffer[0x14E] = 0
+	buffer[0x14F] = 0
+	checksum = sum(buffer) & 0xFFFF
+	buffer[0x14E] = checksum >> 8
+	buffer[0x14F] = checksum & 0xFF
+	with open(file, "wb") as f: f.write(buffer)
+
+def make_corpus(path, count=60, seed=1, min_size=0x8000, max_size=0x800000, sram=0.3, saves=0.5, trimmed=0.1, subtitles=0.3):
+	# Writes `count` ROMs (and some save files) to `path` and returns the total number of bytes
+	rng = random.Random(seed)
+	os.makedirs(path, exist_ok=True)
+	sizes = [ size for size in rom_sizes if min_size <= size <= max_size ]
+	weights = [ rom_size_weights[rom_sizes.index(size)] for size in sizes ]
+	total = 0
+	for i in range(0, count):
+		size = rng.choices(sizes, weights)[0]
+		file_size = size
+		if size > 0x8000 and rng.random() < trimmed:
+			file_size = size - rng.randrange(1, size // 4)
+		ram = rng.choice([ 1, 2, 3 ]) if rng.random() < sram else 0
+		title = "BENCH{:03d}".format(i)
+		name = "#{:03d} {:s}".format(i + 1, title)
+		if rng.random() < subtitles:
+			name += "~" + "".join(rng.choices(subtitle_chars, k=rng.randint(2, 6)))
+		ext = ".gbc" if rng.random() < 0.5 else ".gb"
+		file = os.path.join(path, name + ext)
+		make_rom(file, size, title, rng.choice(mappers), ram, 0x80 if ext == ".gbc" else 0x00, file_size, seed * 1000 + i)
+		total += file_size
+		if ram > 0 and rng.random() < saves:
+			with open(os.path.join(path, name + ".sav"), "wb") as f: f.write(rng.randbytes([ 0, 0x800, 0x2000, 0x8000 ][ram]))
+	return total
+
+################################
+
+def run_builder(module, work_dir, jobs, packing):
+	# Times a build, an export and an import; the phases inside build_compilation come from its
+	# own timings, with the times of phases that run on several threads added up
+	repo_dir = os.path.dirname(os.path.abspath(__file__))
+	cn = "title_image" in vars(module.BuildOptions())
+	menu = os.path.join(repo_dir, module.default_menu_file)
+	kwargs = { "file":os.path.join(work_dir, "BENCH.gbc"), "menu":menu, "jobs":jobs, "packing":packing, "toc":"hide", "cache":None }
+	if cn: kwargs["title_image"] = os.path.join(repo_dir, module.default_title_file)
+	phases = {}
+	sources = module.get_rom_sources()
+
+	with contextlib.redirect_stdout(io.StringIO()):
+		t = time.perf_counter()
+		result = module.build_compilation(sources, module.BuildOptions(timings=True, **kwargs))
+		phases["build"] = time.perf_counter() - t
+		for (phase, names) in build_phase_groups.items():
+			phases[phase] = sum([ result.timings[name]["seconds"] for name in names if name in result.timings ])
+
+		t = time.perf_counter()
+		exported = module.export_compilation(result.files[0], module.BuildOptions(jobs=jobs))
+		phases["export"] = time.perf_counter() - t
+
+		# Every save data file is changed, so the import really writes the compilation SRAM
+		for file in [ file for file in exported.files if file.endswith(".sav") ]:
+			with open(file, "r+b") as f:
+				value = f.read(1)
+				if len(value) == 0: continue
+				f.seek(0)
+				f.write(bytes([ value[0] ^ 0xFF ]))
+		t = time.perf_counter()
+		if result.file_sram is not None:
+			module.import_sram(result.files[0], module.BuildOptions(jobs=jobs))
+			phases["import"] = time.perf_counter() - t
+		else:
+			phases["import"] = None
+
+	return {
+		"builder":module.__name__,
+		"version":module.app_version,
+		"roms":len(result.roms),
+		"rom_size":result.rom_size,
+		"used_space":result.used_space,
+		"phases":phases,
+		"build_phases":result.timings,
+	}
+
+def main():
+	print("\n256M ROM Builder Benchmark\n")
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--count", help="sets the number of synthetic ROMs", type=int, default=60)
+	parser.add_argument("--seed", help="sets the seed of the synthetic ROMs", type=int, default=1)
+	parser.add_argument("--min-size", help="sets the smallest ROM size in KB", type=int, default=32)
+	parser.add_argument("--max-size", help="sets the largest ROM size in KB", type=int, default=8192)
+	parser.add_argument("--sram", help="sets the share of ROMs that use SRAM", type=float, default=0.3)
+	parser.add_argument("--trimmed", help="sets the share of ROMs with a size that is not a power of 2", type=float, default=0.1)
+	parser.add_argument("--subtitles", help="sets the share of ROMs with a Chinese subtitle", type=float, default=0.3)
+	parser.add_argument("--builder", help="sets which builders to run", choices=["en", "cn", "both"], type=str.lower, default="both")
+	parser.add_argument("--jobs", help="sets how many ROM files are read at the same time", type=int, default=os.cpu_count() or 1)
+	parser.add_argument("--packing", help="sets how ROMs are arranged", choices=["optimal", "greedy"], type=str.lower, default="optimal")
+	parser.add_argument("--repeat", help="sets how many times every builder runs", type=int, default=1)
+	parser.add_argument("--dir", help="sets the directory for the synthetic ROMs and output files (default: temporary directory)", type=str, default=None)
+	parser.add_argument("--output", help="sets the file that results are appended to", type=str, default=default_output_file)
+	args = parser.parse_args()
+
+	repo_dir = os.path.dirname(os.path.abspath(__file__))
+	sys.path.insert(0, repo_dir)
+	builders = { "en":[ "256m_rom_builder" ], "cn":[ "256m_rom_builder_cn" ], "both":[ "256m_rom_builder", "256m_rom_builder_cn" ] }[args.builder]
+	output_file = os.path.abspath(args.output)
+	work_dir = args.dir if args.dir is not None else tempfile.mkdtemp(prefix="256m_benchmark_")
+	work_dir = os.path.abspath(work_dir)
+	cwd = os.getcwd()
+
+	try:
+		t = time.perf_counter()
+		corpus_size = make_corpus(os.path.join(work_dir, "roms"), args.count, args.seed, args.min_size * 1024, args.max_size * 1024, args.sram, 0.5, args.trimmed, args.subtitles)
+		print("Generated {:d} ROM(s) with {:.2f} MB in {:.2f} seconds".format(args.count, corpus_size / 1024 / 1024, time.perf_counter() - t))
+
+		os.chdir(work_dir)
+		for name in builders:
+			module = importlib.import_module(name)
+			if name.endswith("_cn"):
+				module.subtitle_font = os.path.join(repo_dir, module.subtitle_font)
+				if not os.path.exists(module.subtitle_font):
+					print("Skipping {:s} because “{:s}” was not found".format(name, module.subtitle_font))
+					continue
+			for i in range(0, args.repeat):
+				run = run_builder(module, work_dir, args.jobs, args.packing)
+				run["date"] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+				run["python"] = platform.python_version()
+				run["platform"] = platform.platform()
+				run["cpus"] = os.cpu_count()
+				run["jobs"] = args.jobs
+				run["packing"] = args.packing
+				run["corpus"] = { "count":args.count, "seed":args.seed, "min_size":args.min_size * 1024, "max_size":args.max_size * 1024, "sram":args.sram, "trimmed":args.trimmed, "subtitles":args.subtitles, "bytes":corpus_size }
+				with open(output_file, "a", encoding="utf-8") as f: f.write(json.dumps(run, ensure_ascii=False) + "\n")
+
+				print("\n{:s} v{:s} (run {:d}, {:d} ROMs placed)".format(name, run["version"], i + 1, run["roms"]))
+				for (phase, seconds) in run["phases"].items():
+					print("  {:10s} {:s}".format(phase, "-" if seconds is None else "{:8.3f} s".format(seconds)))
+				print("  Inside the build:")
+				for (phase, timing) in run["build_phases"].items():
+					print("    {:20s} {:8.3f} s".format(phase, timing["seconds"]))
+	finally:
+		os.chdir(cwd)
+		if args.dir is None: shutil.rmtree(work_dir, ignore_errors=True)
+
+	print("\nResults were appended to “{:s}”".format(output_file))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,1853 @@
+# -*- coding: utf-8 -*-
+# 256M ROM Builder
+# Author: Lesserkuma (github.com/lesserkuma)
+#
+# Build engine shared by both builders. Everything that depends on the menu ROM is done by
+# the builder script ("menu backend") that is passed to the functions here.
+
+import math, glob, os, datetime, time, hashlib, sys, argparse, struct, bisect, collections, json, mmap, concurrent.futures, threading, contextlib, functools, tracemalloc, fnmatch, io, importlib, select
+try:
+	import resource
+except ImportError:
+	resource = None
+
+# Configuration
+default_file = "256MROMSET_<CODE>.gbc"
+default_roms_dir = "roms"
+cache_max_entries = 20000
+plan_packing_time = 0.1 # placement search time limit of a dry run
+menu_backends = { "en":"256m_rom_builder", "cn":"256m_rom_builder_cn" }
+menu_names = { "en":"English", "cn":"Chinese" }
+
+################################
+
+# Menu ROM Parameters
+max_roms = 108
+max_space = 0x2000000
+
+# Lookup Tables
+v7001_values = {0x800000:0x00, 0x400000:0x80, 0x200000:0xC0, 0x100000:0xE0, 0x80000:0xF0, 0x40000:0xF8, 0x20000:0xFC, 0x10000:0xFE, 0x8000:0xFF}
+sram_sizes = [0, 0x800, 0x2000, 0x8000]
+logo_hash = bytearray([ 0x07, 0x45, 0xFD, 0xEF, 0x34, 0x13, 0x2D, 0x1B, 0x3D, 0x48, 0x8C, 0xFB, 0xDF, 0x03, 0x79, 0xA3, 0x9F, 0xD5, 0x4B, 0x4C ])
+
+# Initialization
+log_stream = None # log file of the command line interface
+log_captures = [] # logged lines of every call that is running
+menu_cache = {}
+
+class ArgParseCustomFormatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawDescriptionHelpFormatter): pass
+
+class BuildError(Exception): pass
+
+class BuildOptions:
+	# Settings of every builder; the menu ROM file and other menu settings are set by the
+	# subclass of each builder before this runs
+	def __init__(self, **kwargs):
+		self.split = False
+		self.toc = "index"
+		self.file = default_file
+		self.packing = "optimal"
+		self.packing_time = 1.0
+		self.jobs = os.cpu_count() or 1
+		self.cache = None
+		self.update = None
+		self.plan = False
+		self.timings = False
+		self.variants = []
+		self.report = None
+		for (k, v) in kwargs.items():
+			setattr(self, k, v)
+
+class FreeSpaceIndex:
+	# Buddy tree over the compilation space; every node holds the size of the largest
+	# free aligned block inside it, so lookups only walk one path from the root
+	def __init__(self, size=max_space, block_size=0x8000, sram_slot_size=0x200000):
+		self.size = size
+		self.block_size = block_size
+		self.sram_slot_size = sram_slot_size
+		self.sram_slots = 0 # bitmap of used SRAM slots
+		self.end = 0
+		self.largest = [0] * (2 * (size // block_size))
+		for i in range(1, len(self.largest)):
+			self.largest[i] = size >> (i.bit_length() - 1)
+
+	def _node(self, pos, size):
+		depth = (self.size // size).bit_length() - 1
+		return (1 << depth) + (pos // size)
+
+	def is_free(self, pos, size):
+		if size < self.block_size: size = self.block_size
+		if size > self.size or (size & (size - 1)) != 0: return False
+		if pos % size > 0 or pos + size > self.size: return False
+		target = self._node(pos, size)
+		depth = target.bit_length() - 1
+		node_size = self.size
+		for d in range(0, depth + 1):
+			node = target >> (depth - d)
+			if self.largest[node] == node_size: return True
+			if self.largest[node] < size: return False
+			node_size >>= 1
+		return False
+
+	def find(self, size):
+		# Returns the lowest free offset that is aligned to the size
+		if size < self.block_size: size = self.block_size
+		if self.largest[1] < size: return None
+		node = 1
+		node_size = self.size
+		while node_size > size and self.largest[node] != node_size:
+			node = node * 2
+			node_size >>= 1
+			if self.largest[node] < size: node += 1
+		return (node - (1 << (node.bit_length() - 1))) * node_size
+
+	def allocate(self, pos, size, sram=False):
+		if size < self.block_size: size = self.block_size
+		node = self._node(pos, size)
+		self.largest[node] = 0
+		node_size = size
+		while node > 1:
+			node >>= 1
+			left = self.largest[node * 2]
+			right = self.largest[node * 2 + 1]
+			if left == node_size and right == node_size:
+				self.largest[node] = node_size * 2
+			else:
+				self.largest[node] = max(left, right)
+			node_size *= 2
+		if sram: self.sram_slots |= 1 << (pos // self.sram_slot_size)
+		self.end = max(self.end, pos + size)
+
+	def is_sram_slot_free(self, slot):
+		return (self.sram_slots >> slot) & 1 == 0
+
+	def sram_slots_used(self):
+		return bin(self.sram_slots).count("1")
+
+class RomCache:
+	# Parsed ROM headers and checksums kept on disk between runs; a record is only used
+	# for as long as the path, size and modification time of its file stay the same and the
+	# cache was written by the same builder version
+	fields = ("title", "subtitle", "sram_size", "mapper", "size", "file_size", "hash", "header", "sum", "checksum", "content_hash")
+	hex_fields = { "hash":bytes, "header":bytearray, "checksum":bytes, "content_hash":bytes }
+
+	def __init__(self, file=None, version=None, max_entries=cache_max_entries):
+		self.file = file
+		self.version = version
+		self.max_entries = max_entries
+		self.records = {}
+		self.now = time.time()
+		if file is None or not os.path.exists(file): return
+		try:
+			with open(file, "r", encoding="utf-8") as f: data = json.load(f)
+			if data["version"] == version: self.records = data["records"]
+		except (OSError, ValueError, KeyError, TypeError):
+			self.records = {}
+
+	def get(self, file, stat):
+		# Returns (True, info) for a known file, with info being None if it is not a ROM
+		record = self.records.get(file)
+		if record is None or record["file_size"] != stat.st_size or record["mtime"] != stat.st_mtime_ns:
+			return (False, None)
+		record["used"] = self.now
+		if record["info"] is None: return (True, None)
+		info = dict(record["info"])
+		for (k, t) in self.hex_fields.items():
+			if k in info: info[k] = t.fromhex(info[k])
+		info["filename"] = file
+		return (True, info)
+
+	def put(self, file, stat, info):
+		record = { "file_size":stat.st_size, "mtime":stat.st_mtime_ns, "used":self.now, "info":None }
+		if info is not None:
+			record["info"] = { k:(v.hex() if k in self.hex_fields else v) for (k, v) in info.items() if k in self.fields }
+		self.records[file] = record
+
+	def update(self, info):
+		# Keeps the checksums and content hash of a ROM that were calculated during a build
+		record = self.records.get(info["filename"])
+		if record is None or record["info"] is None: return
+		if "content_hash" in info: record["info"]["content_hash"] = info["content_hash"].hex()
+		if "sum" not in info: return
+		record["info"]["sum"] = info["sum"]
+		record["info"]["checksum"] = info["checksum"].hex()
+
+	def save(self):
+		if self.file is None: return
+		# Least recently used records go first once the cache is full
+		records = sorted(self.records.items(), key=lambda item: item[1]["used"], reverse=True)[:self.max_entries]
+		with open(self.file + ".tmp", "w", encoding="utf-8") as f:
+			json.dump({ "version":self.version, "records":dict(records) }, f)
+		os.replace(self.file + ".tmp", self.file)
+
+class BuildResult:
+	def __init__(self, menu=None):
+		self.files = []
+		self.file_sram = None
+		self.rom_code = None
+		self.build_date = None
+		self.rom_size = 0
+		self.used_space = 0
+		self.roms = []
+		self.rejected = []
+		self.packing = None
+		self.timings = {}
+		self.variants = []
+		self.menu = menu
+		self.log = ""
+
+class Timings:
+	# Wall time, bytes read and written and peak memory of every build phase. Phases can be
+	# nested and the times of a phase that runs on several threads at once are added up.
+	# Peak traced memory is the highest Python allocation since the previous phase ended; max RSS
+	# is the highest resident memory of the whole process up to the end of the phase.
+	def __init__(self):
+		self.enabled = False
+		self.tracing = False
+		self.phases = {}
+		self.lock = threading.Lock()
+
+	def start(self):
+		self.phases = {}
+		self.enabled = True
+		# Tracing that was started by someone else is left running
+		if not tracemalloc.is_tracing():
+			tracemalloc.start()
+			self.tracing = True
+		tracemalloc.reset_peak()
+
+	def stop(self):
+		self.enabled = False
+		if self.tracing: tracemalloc.stop()
+		self.tracing = False
+		return self.phases
+
+	@contextlib.contextmanager
+	def phase(self, name, read=0, written=0):
+		counters = { "read":read, "written":written }
+		if not self.enabled:
+			yield counters
+			return
+		start = time.perf_counter()
+		try:
+			yield counters
+		finally:
+			self.add(name, time.perf_counter() - start, counters["read"], counters["written"])
+
+	def add(self, name, seconds, read=0, written=0):
+		if not self.enabled: return
+		with self.lock:
+			if name not in self.phases:
+				self.phases[name] = { "calls":0, "seconds":0, "read":0, "written":0, "max_rss":0, "peak_traced":0 }
+			phase = self.phases[name]
+			phase["calls"] += 1
+			phase["seconds"] += seconds
+			phase["read"] += read
+			phase["written"] += written
+			phase["max_rss"] = max(phase["max_rss"], get_max_rss())
+			if tracemalloc.is_tracing():
+				phase["peak_traced"] = max(phase["peak_traced"], tracemalloc.get_traced_memory()[1])
+				tracemalloc.reset_peak()
+
+timings = Timings()
+
+def get_max_rss():
+	if resource is None: return 0
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == "darwin": return peak
+	return peak * 1024
+
+def FixHeaderChecksum(buffer):
+	checksum = 0
+	for i in range(0x134, 0x14D):
+		checksum = checksum - buffer[i] - 1
+	checksum = checksum & 0xFF
+	buffer[0x14D] = checksum
+	return buffer
+
+def FixChecksums(buffer):
+	# Also returns the sum of all bytes, which is what the global checksum is made of
+	buffer = FixHeaderChecksum(buffer)
+	buffer[0x14E] = 0
+	buffer[0x14F] = 0
+	total = get_byte_sum(buffer)
+	checksum = total & 0xFFFF
+	buffer[0x14E] = checksum >> 8
+	buffer[0x14F] = checksum & 0xFF
+	return (buffer, total + buffer[0x14E] + buffer[0x14F])
+
+def get_byte_sum(buffer, chunk_size=0x10000):
+	# Summed in chunks so other threads get to run in between
+	total = 0
+	for i in range(0, len(buffer), chunk_size):
+		total += sum(buffer[i:i+chunk_size])
+	return total
+
+def formatFileSize(size):
+	if size == 1:
+		return "{:d} Byte".format(size)
+	elif size < 1024:
+		return "{:d} Bytes".format(size)
+	elif size < 1024 * 1024:
+		val = size/1024
+		return "{:.1f} KB".format(val)
+	else:
+		val = size/1024/1024
+		return "{:.2f} MB".format(val)
+
+def logp(*args, **kwargs):
+	s = format(" ".join(map(str, args)))
+	print("{:s}".format(s))
+	for lines in log_captures: lines.append("{:s}\n".format(s))
+	if log_stream is not None: log_stream.write("{:s}\n".format(s))
+
+@contextlib.contextmanager
+def capture_log():
+	# Collects the lines that are logged inside the block
+	lines = []
+	log_captures.append(lines)
+	try:
+		yield lines
+	finally:
+		log_captures.remove(lines)
+
+def logged(function):
+	# The lines that a call logs are kept with the BuildResult it returns
+	@functools.wraps(function)
+	def wrapper(*args, **kwargs):
+		with capture_log() as lines:
+			result = function(*args, **kwargs)
+		result.log = "".join(lines)
+		return result
+	return wrapper
+
+def get_rom_sources(path=default_roms_dir):
+	files = glob.glob(os.path.join(glob.escape(path), "*.*"))
+	files.sort()
+	return files
+
+def load_menu(file):
+	if not os.path.exists(file):
+		raise BuildError("Error: Menu ROM file not found!")
+	mtime = os.stat(file).st_mtime_ns
+	if file not in menu_cache or menu_cache[file][0] != mtime:
+		with open(file, "rb") as f: menu_cache[file] = (mtime, bytes(f.read()))
+	return bytearray(menu_cache[file][1])
+
+def get_sram_size(buffer):
+	if buffer[0x149] > 0:
+		if buffer[0x149] < len(sram_sizes):
+			return sram_sizes[buffer[0x149]]
+		else:
+			return 0x8000
+	elif buffer[0x147] == 0x06: # MBC2
+		return 512
+	else:
+		return 0
+
+def get_mapper(buffer):
+	mapper = buffer[0x147]
+	if mapper == 0x00: return "None"
+	elif mapper in (0x01, 0x02, 0x03): return "MBC1"
+	elif mapper == 0x06: return "MBC2"
+	elif mapper in (0x10, 0x13): return "MBC3"
+	elif mapper in (0x19, 0x1A, 0x1B, 0x1C, 0x1E): return "MBC5"
+	elif mapper == 0x20: return "MBC6"
+	elif mapper == 0x22: return "MBC7"
+	elif mapper in (0x0B, 0x0D): return "MMM01"
+	elif mapper == 0xFC: return "GBD"
+	elif mapper == 0xFF: return "HuC-1"
+	elif mapper == 0xFE: return "HuC-3"
+	elif mapper == 0xFD: return "TAMA5"
+	else: return "Unknown"
+
+def discover_rom(backend, file):
+	# Only the header is read here, the ROM data is loaded once the ROM gets placed; the menu
+	# backend reads the title and anything else its menu shows from the file name or header
+	info = {}
+	file_size = os.stat(file).st_size
+	if file_size > 0x800000 or file_size < 0x150: return None
+	with open(file, "rb") as f: buffer = bytearray(f.read(0x200))
+	with timings.phase("logo check"):
+		valid = hashlib.sha1(buffer[0x104:0x134]).digest() == logo_hash
+	if not valid: return None
+
+	sram_size = get_sram_size(buffer)
+	mapper = get_mapper(buffer)
+
+	(labels, no_sram) = backend.get_rom_labels(file, buffer)
+	if no_sram: sram_size = 0
+
+	# Pad ROM to next power of 2 if trimmed
+	rom_size = file_size
+	if ((rom_size & (rom_size - 1)) != 0):
+		x = 128
+		while (x < rom_size): x *= 2
+		rom_size = x
+	if len(buffer) < 0x200:
+		buffer = buffer + bytearray([0xFF] * (0x200 - len(buffer)))
+
+	info["filename"] = file
+	info.update(labels)
+	info["sram_size"] = sram_size
+	info["mapper"] = mapper
+	info["size"] = rom_size
+	info["file_size"] = file_size
+	info["hash"] = hashlib.sha1(buffer[0:0x200]).digest()
+	info["header"] = buffer
+	return info
+
+def get_header_key(header):
+	# Identifies a ROM header without the checksums that get fixed when the ROM is added
+	return hashlib.sha1(bytes(header[0:0x14D]) + bytes(header[0x150:0x200])).digest()
+
+def get_content_hash(info):
+	with open(info["filename"], "rb") as f: return hashlib.sha1(f.read()).digest()
+
+def find_duplicates(roms, jobs=1, read=True):
+	# ROMs with the same file size and header are compared by a hash of the whole file; every
+	# copy is marked with the index of the ROM whose data it will share, preferring one that
+	# uses SRAM. Without reading, ROMs whose content hash is not cached are treated as distinct.
+	groups = {}
+	for rom in roms:
+		groups.setdefault((rom["file_size"], get_header_key(rom["header"])), []).append(rom)
+	groups = [ group for group in groups.values() if len(group) > 1 ]
+	missing = [ rom for group in groups for rom in group if "content_hash" not in rom ]
+	if read and len(missing) > 0:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+			for (rom, content_hash) in zip(missing, pool.map(get_content_hash, missing)):
+				rom["content_hash"] = content_hash
+	for group in groups:
+		copies = {}
+		for rom in group:
+			if "content_hash" in rom: copies.setdefault(rom["content_hash"], []).append(rom)
+		for copy in copies.values():
+			copy.sort(key=lambda item: (item["sram_size"] == 0, item["index"]))
+			for rom in copy[1:]: rom["duplicate_of"] = copy[0]["index"]
+	return [ rom for rom in roms if "duplicate_of" not in rom ]
+
+def read_rom(info):
+	with timings.phase("rom read") as counters:
+		with open(info["filename"], "rb") as f: buffer = bytearray(f.read(info["size"]))
+		counters["read"] = len(buffer)
+	if "content_hash" not in info and len(buffer) == info["file_size"]:
+		info["content_hash"] = hashlib.sha1(buffer).digest()
+	if len(buffer) < info["size"]:
+		with timings.phase("padding"):
+			buffer = buffer + bytearray([0xFF] * (info["size"] - len(buffer)))
+	if "sum" in info:
+		# Checksums are already known from an earlier run
+		buffer[0x14D:0x150] = info["checksum"]
+		return (buffer, info["sum"])
+	with timings.phase("FixChecksums"):
+		(buffer, info["sum"]) = FixChecksums(buffer)
+	info["checksum"] = bytes(buffer[0x14D:0x150])
+	return (buffer, info["sum"])
+
+def read_roms(roms, jobs=1):
+	# Yields every ROM with the sum of its bytes in the given order; with more than one job the
+	# next few ROMs are read and checksummed by a thread pool while the current one is written
+	if jobs <= 1:
+		for rom in roms: yield read_rom(rom)
+		return
+	with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+		pending = collections.deque()
+		for rom in roms:
+			pending.append(pool.submit(read_rom, rom))
+			if len(pending) > jobs: yield pending.popleft().result()
+		while len(pending) > 0: yield pending.popleft().result()
+
+def read_rom_sram(info):
+	file_sram = "{:s}.sav".format(os.path.splitext(info["filename"])[0])
+	if not os.path.exists(file_sram): return None
+	with timings.phase("save data read") as counters:
+		with open(file_sram, "rb") as f: buffer_sram = bytearray(f.read(0x8000))
+		counters["read"] = len(buffer_sram)
+	return buffer_sram
+
+def place_roms_greedy(roms, space=None):
+	# Carefully align ROMs
+	# - They must always be in a location that is divisible by their ROM size
+	# - There also can only be one SRAM-enabled ROM every 0x200000 bytes
+	# SRAM-enabled ROMs go first
+	if space is None:
+		space = FreeSpaceIndex()
+		space.allocate(0, 0x8000)
+	placement = {}
+	sram_addr = []
+	for i in range(0, max_space, 0x200000): sram_addr.append(i)
+	start = time.perf_counter()
+	for rom in roms:
+		if rom["sram_size"] > 0:
+			sram_addr[0] = rom["size"]
+			for pos in sram_addr:
+				sram_slot = math.floor(pos / 0x200000)
+				if not space.is_sram_slot_free(sram_slot): continue
+				if space.is_free(pos, rom["size"]):
+					placement[rom["index"]] = pos
+					space.allocate(pos, rom["size"], sram=True)
+					break
+	timings.add("SRAM placement", time.perf_counter() - start)
+
+	# Now fill up the rest
+	start = time.perf_counter()
+	for rom in roms:
+		if rom["sram_size"] == 0:
+			pos = space.find(rom["size"])
+			if pos is not None:
+				placement[rom["index"]] = pos
+				space.allocate(pos, rom["size"])
+	timings.add("non-SRAM placement", time.perf_counter() - start)
+	return placement
+
+def keep_roms(roms, layout, jobs=1, read=True):
+	# Finds the ROMs that are already inside the compilation that gets updated; a ROM is
+	# kept where it is if its size, header, checksums and SRAM usage are all unchanged.
+	# Without reading, ROMs whose checksums are not cached are only compared by header.
+	entries = {}
+	for entry in layout["entries"]:
+		entries.setdefault((entry["size"], entry["header_key"]), []).append(entry)
+	candidates = [ rom for rom in roms if (rom["size"], get_header_key(rom["header"])) in entries ]
+	if read:
+		for _ in read_roms([ rom for rom in candidates if "checksum" not in rom ], jobs): pass
+
+	space = FreeSpaceIndex()
+	space.allocate(0, 0x8000)
+	placement = {}
+	for rom in sorted(candidates, key=lambda item: item["index"]):
+		for entry in entries[(rom["size"], get_header_key(rom["header"]))]:
+			if entry["checksum"] != rom.get("checksum", entry["checksum"]) or ("sram_id" in entry) != (rom["sram_size"] > 0): continue
+			entries[(rom["size"], get_header_key(rom["header"]))].remove(entry)
+			placement[rom["index"]] = entry["offset"]
+			space.allocate(entry["offset"], rom["size"], sram=rom["sram_size"] > 0)
+			rom["kept"] = True
+			break
+	return (placement, space)
+
+def get_placement_score(roms, placement, limit=max_roms):
+	# Only the first ROMs in index order make it into the menu
+	placed = sorted([ rom for rom in roms if rom["index"] in placement ], key=lambda item: item["index"])[:limit]
+	return (len(placed), sum([ rom["size"] for rom in placed ]))
+
+def place_roms_optimal(roms, baseline=(0, 0), time_budget=1.0, limit=max_roms):
+	# Works on the levels of the buddy tree, from 32 MB down to 32 KB.
+	# ROM sizes are powers of two, so the free blocks of a level only depend on how many
+	# blocks the larger ROMs took, not on where they went. Each level is therefore decided
+	# by counts: how many ROMs of that size to add, and at the 2 MB level how many slots to
+	# reserve for smaller SRAM-enabled ROMs. Such a ROM sits at the start of its reserved
+	# slot and leaves one free block of every size between its own and 1 MB ("chains").
+	# A single SRAM-enabled ROM can also share the first slot with the menu.
+	slot_size = 0x200000
+	levels = []
+	size = max_space
+	while size >= 0x8000:
+		levels.append(size)
+		size //= 2
+	plain = { size:[] for size in levels }
+	sram = { size:[] for size in levels }
+	for rom in sorted(roms, key=lambda item: item["index"]):
+		size = max(rom["size"], 0x8000)
+		if rom["sram_size"] > 0 and size <= slot_size:
+			sram[size].append(rom)
+		else:
+			plain[size].append(rom)
+
+	# Sizes of all ROMs at or below each level, for the upper bounds
+	remaining = []
+	plain_left = []
+	sram_left = []
+	for i in range(0, len(levels)):
+		sizes = []
+		for size in levels[i:]:
+			sizes += [ size ] * (len(plain[size]) + len(sram[size]))
+		sizes.sort()
+		prefix = [ 0 ]
+		for size in sizes: prefix.append(prefix[-1] + size)
+		remaining.append(prefix)
+		plain_left.append(sum([ len(plain[size]) for size in levels[i:] ]))
+		sram_left.append(sum([ len(sram[size]) for size in levels[i:] ]))
+
+	def native(size):
+		# After the menu took the first 32 KB, one free block of every smaller size is left
+		return 1 if size < max_space else 0
+
+	def fit(counts_plain, counts_sram):
+		# Choice per level for a fixed number of ROMs of every size, or None if they do not fit
+		small_sram = sum([ counts_sram[size] for size in levels if size < slot_size ])
+		for slot0 in [ None ] + [ size for size in levels if size < slot_size and counts_sram[size] > 0 ]:
+			carry = 0
+			chains = 0
+			choice = []
+			for size in levels:
+				avail = carry + chains + native(size)
+				if size > slot_size:
+					step = (counts_plain[size], 0, 0)
+					used = counts_plain[size]
+				elif size == slot_size:
+					step = (counts_sram[size], counts_plain[size], small_sram - (1 if slot0 is not None else 0))
+					used = sum(step)
+				else:
+					z = 1 if slot0 == size else 0
+					step = (z, counts_sram[size] - z, counts_plain[size])
+					used = z + counts_plain[size]
+				if used > avail: break
+				carry = 2 * (avail - used)
+				if size == slot_size: chains = step[2]
+				elif size < slot_size: chains -= step[1]
+				choice.append(step)
+			else:
+				return choice
+		return None
+
+	def get_counts(sizes, n):
+		counts = { size:0 for size in levels }
+		for size in sizes[:n]: counts[size] += 1
+		return counts
+
+	def fit_smallest(sizes_plain, sizes_sram, m, j):
+		return fit(get_counts(sizes_plain, m), get_counts(sizes_sram, j))
+
+	# Most ROMs first: swapping a ROM for a smaller one of the same kind never breaks a
+	# placement, so only the smallest plain and SRAM-enabled ROMs need to be tried.
+	sizes_plain = sorted([ size for size in levels for rom in plain[size] ])
+	sizes_sram = sorted([ size for size in levels for rom in sram[size] ])
+	best = { "score":baseline, "choice":None, "exact":True }
+	for j in range(0, min(len(sizes_sram), limit) + 1):
+		if fit_smallest(sizes_plain, sizes_sram, 0, j) is None: break
+		(lo, hi) = (0, min(len(sizes_plain), limit - j))
+		while lo < hi:
+			mid = (lo + hi + 1) // 2
+			if fit_smallest(sizes_plain, sizes_sram, mid, j) is None:
+				hi = mid - 1
+			else:
+				lo = mid
+		if j + lo < best["score"][0]: continue
+
+		# Trade ROMs for larger ones of the same kind for as long as everything still fits
+		counts = { "plain":get_counts(sizes_plain, lo), "sram":get_counts(sizes_sram, j) }
+		pool = { "plain":plain, "sram":sram }
+		swapped = True
+		while swapped:
+			swapped = False
+			for kind in counts:
+				for large in [ size for size in levels if counts[kind][size] < len(pool[kind][size]) ]:
+					for small in [ size for size in reversed(levels) if size < large and counts[kind][size] > 0 ]:
+						counts[kind][small] -= 1
+						counts[kind][large] += 1
+						if fit(counts["plain"], counts["sram"]) is not None:
+							swapped = True
+							break
+						counts[kind][small] += 1
+						counts[kind][large] -= 1
+		score = (j + lo, sum([ (counts["plain"][size] + counts["sram"][size]) * size for size in levels ]))
+		if score > best["score"]:
+			best["score"] = score
+			best["choice"] = fit(counts["plain"], counts["sram"])
+
+	# Then branch and bound for the arrangement of that many ROMs that uses the most space
+	count_max = best["score"][0]
+	deadline = time.perf_counter() + time_budget
+
+	def search(i, carry, chains, slot0_used, count, total, choice):
+		if time.perf_counter() > deadline:
+			best["exact"] = False
+			return
+		if i == len(levels):
+			if chains == 0 and (count, total) > best["score"]:
+				best["score"] = (count, total)
+				best["choice"] = list(choice)
+			return
+		size = levels[i]
+		avail = carry + chains + native(size)
+
+		# Upper bound: fill the remaining free bytes with the smallest ROMs left, but only
+		# as many SRAM-enabled ROMs as there are 2 MB slots left for them
+		free_bytes = (avail + chains) * size + sum([ native(s) * s for s in levels[i+1:] ])
+		if size > slot_size:
+			slots = avail * (size // slot_size) + sum([ native(s) * s // slot_size for s in levels[i+1:] if s >= slot_size ])
+		elif size == slot_size:
+			slots = avail
+		else:
+			slots = chains
+		if not slot0_used: slots += 1
+		prefix = remaining[i]
+		bound_count = min(count_max, count + bisect.bisect_right(prefix, free_bytes) - 1, count + plain_left[i] + min(sram_left[i], slots))
+		bound_total = total + min(free_bytes, prefix[-1])
+		if (bound_count, bound_total) <= best["score"]: return
+
+		if size > slot_size:
+			for k in range(min(avail, len(plain[size]), limit - count), -1, -1):
+				choice.append((k, 0, 0))
+				search(i + 1, 2 * (avail - k), 0, slot0_used, count + k, total + k * size, choice)
+				choice.pop()
+		elif size == slot_size:
+			chains_max = sum([ len(sram[s]) for s in levels[i+1:] ])
+			for a in range(min(avail, len(sram[size]), limit - count), -1, -1):
+				for b in range(min(avail - a, len(plain[size]), limit - count - a), -1, -1):
+					for r in range(min(avail - a - b, chains_max), -1, -1):
+						choice.append((a, b, r))
+						search(i + 1, 2 * (avail - a - b - r), r, slot0_used, count + a + b, total + (a + b) * size, choice)
+						choice.pop()
+		else:
+			z_max = 1 if not slot0_used and len(sram[size]) > 0 else 0
+			for z in range(z_max, -1, -1):
+				for t in range(min(chains, len(sram[size]) - z, limit - count - z), -1, -1):
+					for n in range(min(avail - z, len(plain[size]), limit - count - z - t), -1, -1):
+						choice.append((z, t, n))
+						search(i + 1, 2 * (avail - z - n), chains - t, slot0_used or z > 0, count + z + t + n, total + (z + t + n) * size, choice)
+						choice.pop()
+
+	if best["score"][0] < len(roms):
+		search(0, 0, 0, False, 0, 0, [])
+	if best["choice"] is None: return (None, best["exact"])
+
+	# Turn the chosen counts into offsets, largest ROMs first
+	space = FreeSpaceIndex()
+	space.allocate(0, 0x8000)
+	placement = {}
+	slot0_roms = []
+	chain_roms = []
+	plain_roms = []
+	for (i, size) in enumerate(levels):
+		(x, y, z) = best["choice"][i]
+		if size > slot_size:
+			plain_roms += plain[size][:x]
+		elif size == slot_size:
+			plain_roms += sram[size][:x] + plain[size][:y]
+		else:
+			slot0_roms += sram[size][:x]
+			chain_roms += sram[size][x:x+y]
+			plain_roms += plain[size][:z]
+	for rom in [ rom for rom in plain_roms if rom["size"] >= slot_size ] + chain_roms + slot0_roms + [ rom for rom in plain_roms if rom["size"] < slot_size ]:
+		size = max(rom["size"], 0x8000)
+		if rom["index"] in [ r["index"] for r in slot0_roms ]:
+			pos = size
+		elif rom["index"] in [ r["index"] for r in chain_roms ]:
+			pos = space.find(slot_size)
+		else:
+			pos = space.find(size)
+		if pos is None or not space.is_free(pos, size): return (None, best["exact"])
+		space.allocate(pos, size, sram=rom["sram_size"] > 0)
+		placement[rom["index"]] = pos
+	return (placement, best["exact"])
+
+def write_compilation(targets, rom_size, roms, split=False, jobs=1):
+	# Streams the menu and the placed ROMs to their offsets and fills the gaps with 0xFF.
+	# Every target is an (output file, menu) pair; all targets get the same ROM data behind
+	# their own menu, so each ROM is read only once. Returns the written files of every target.
+	part_size = 0x800000 if split else rom_size
+	padding = memoryview(bytearray([0xFF] * 0x100000))
+
+	menus = []
+	for (output_file, menu) in targets:
+		menu[0x14E] = 0
+		menu[0x14F] = 0
+		menus.append(FixHeaderChecksum(menu))
+	checksum = 0
+	items = [ (0, None) ]
+	pos = len(menus[0])
+	for rom in sorted(roms, key=lambda item: item["offset"]) + [ None ]:
+		end = rom_size if rom is None else rom["offset"]
+		while pos < end:
+			length = min(end - pos, len(padding) - (pos % len(padding)))
+			items.append((pos, padding[:length]))
+			checksum += 0xFF * length
+			pos += length
+		if rom is None: break
+		items.append((pos, rom))
+		pos += rom["size"]
+
+	# ROMs and padding never cross a part boundary, so every part can be written on its own
+	parts = []
+	for (pos, data) in items:
+		if pos // part_size == len(parts): parts.append([])
+		parts[-1].append((pos, data))
+	files = []
+	for (output_file, menu) in targets:
+		(name, ext) = os.path.splitext(output_file)
+		if split:
+			files.append([ "{:s}_part{:d}{:s}".format(name, i+1, ext) for i in range(0, len(parts)) ])
+		else:
+			files.append([ output_file ])
+
+	def write_part(part_files, part, jobs):
+		part_checksum = 0
+		buffers = read_roms([ data for (pos, data) in part if isinstance(data, dict) ], jobs)
+		with contextlib.ExitStack() as stack:
+			outputs = [ stack.enter_context(open(file, "wb")) for file in part_files ]
+			for (pos, data) in part:
+				if isinstance(data, dict):
+					(data, rom_checksum) = next(buffers)
+					part_checksum += rom_checksum
+				for (i, f) in enumerate(outputs):
+					buffer = menus[i] if data is None else data
+					with timings.phase("output write", written=len(buffer)): f.write(buffer)
+		return part_checksum
+
+	part_files = [ [ target_files[i] for target_files in files ] for i in range(0, len(parts)) ]
+	if len(parts) == 1:
+		checksum += write_part(part_files[0], parts[0], jobs)
+	else:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(jobs, len(parts)))) as pool:
+			checksum += sum(pool.map(write_part, part_files, parts, [ 1 ] * len(parts)))
+
+	# Fix global checksums
+	for (menu, target_files) in zip(menus, files):
+		menu_checksum = (checksum + get_byte_sum(menu)) & 0xFFFF
+		menu[0x14E] = menu_checksum >> 8
+		menu[0x14F] = menu_checksum & 0xFF
+		with open(target_files[0], "r+b") as f:
+			f.seek(0x14E)
+			f.write(menu[0x14E:0x150])
+	return files
+
+def update_compilation_file(output_file, rom_size, menu, roms, jobs=1):
+	# Writes the menu bank and the given ROMs into an existing compilation and adjusts the
+	# global checksum by the bytes that were replaced, so the rest of the file is never read
+	menu[0x14E] = 0
+	menu[0x14F] = 0
+	menu = FixHeaderChecksum(menu)
+	written = 0
+	with open(output_file, "r+b") as f:
+		old_menu = bytearray(f.read(0x8000))
+		checksum = (old_menu[0x14E] << 8) | old_menu[0x14F]
+		old_menu[0x14E] = 0
+		old_menu[0x14F] = 0
+		checksum += get_byte_sum(menu) - get_byte_sum(old_menu)
+
+		# Grow the file if new ROMs go past its end, with 0xFF between them
+		file_size = f.seek(0, os.SEEK_END)
+		padding = bytearray([0xFF] * 0x100000)
+		roms = sorted(roms, key=lambda item: item["offset"])
+		pos = file_size
+		for rom in [ rom for rom in roms if rom["offset"] >= file_size ] + [ None ]:
+			end = rom_size if rom is None else rom["offset"]
+			while pos < end:
+				length = min(end - pos, len(padding))
+				f.seek(pos)
+				with timings.phase("output write", written=length): f.write(padding[:length])
+				checksum += 0xFF * length
+				pos += length
+				written += length
+			if rom is not None: pos = rom["offset"] + rom["size"]
+
+		for (rom, (buffer, rom_checksum)) in zip(roms, read_roms(roms, jobs)):
+			checksum += rom_checksum
+			if rom["offset"] < file_size:
+				f.seek(rom["offset"])
+				checksum -= get_byte_sum(f.read(rom["size"]))
+			f.seek(rom["offset"])
+			with timings.phase("output write", written=len(buffer)): f.write(buffer)
+			written += len(buffer)
+
+		checksum = checksum & 0xFFFF
+		menu[0x14E] = checksum >> 8
+		menu[0x14F] = checksum & 0xFF
+		f.seek(0)
+		with timings.phase("output write", written=len(menu)): f.write(menu)
+		written += len(menu)
+	return written
+
+def label_roms(backend, roms):
+	# Copies of ROMs that were discovered by another menu backend, with the titles and
+	# everything else the menu of `backend` shows. The ROMs are already placed, so a ROM that
+	# this menu can't show as it is only gets the labels from its file name.
+	labeled = []
+	for rom in roms:
+		rom = dict(rom)
+		rom.update(backend.get_rom_labels(rom["filename"], rom["header"])[0])
+		try:
+			rom = backend.prepare_rom(rom)
+		except BuildError as e:
+			logp(str(e))
+			logp("Using the labels from the file name of {:s} in the “{:s}” menu instead".format(rom["filename"], backend.menu_backend))
+			rom = backend.prepare_rom(rom, fallback=True)
+		labeled.append(rom)
+	return labeled
+
+def get_menu_backend(backend, name):
+	if name == backend.menu_backend: return backend
+	if name not in menu_backends:
+		raise BuildError("Error: Unknown menu variant “{:s}”".format(name))
+	try:
+		return importlib.import_module(menu_backends[name])
+	except ImportError as e:
+		raise BuildError("Error: The “{:s}” menu variant could not be loaded. {:s}".format(name, str(e)))
+
+def patch_menu_variants(backend, roms, rom_map, options, rom_size, now):
+	# Other menus for the same placed ROMs, one per menu backend in options.variants
+	variants = []
+	for name in options.variants:
+		if name == backend.menu_backend:
+			raise BuildError("Error: The “{:s}” menu is already built by this builder".format(name))
+		variant_backend = get_menu_backend(backend, name)
+		(base, ext) = os.path.splitext(options.file)
+		variant = { "name":name, "result":BuildResult(name) }
+		variant["options"] = variant_backend.BuildOptions(file=options.file if "<CODE>" in options.file else "{:s}_{:s}{:s}".format(base, name, ext), toc=options.toc, split=options.split, jobs=options.jobs, plan=options.plan)
+		if hasattr(variant_backend, "default_glyph_cache_file") and options.cache is not None:
+			variant["options"].glyph_cache = variant_backend.default_glyph_cache_file
+		logp("\nBuilding the “{:s}” menu variant".format(name))
+		variant["menu"] = load_menu(variant["options"].menu)
+		variant_backend.prepare_build(variant["options"], None)
+		labeled = { rom["index"]:rom for rom in label_roms(variant_backend, roms) }
+		(rom_code, _, variant["result"].roms) = variant_backend.patch_menu(variant["menu"], labeled.values(), { k:labeled[k] for k in rom_map }, variant["options"], now)
+		variant_backend.finish_build(variant["options"])
+		variant["file"] = variant["options"].file.replace("<CODE>", rom_code)
+		variant["result"].rom_code = rom_code
+		variant["result"].rom_size = rom_size
+		variants.append(variant)
+	return variants
+
+@logged
+def build_compilation(backend, rom_sources, options=None):
+	if options is None: options = backend.BuildOptions()
+	if options.timings:
+		timings.start()
+	else:
+		timings.stop()
+	result = BuildResult(backend.menu_backend)
+	now = datetime.datetime.now()
+	rom_map = {}
+	roms = []
+	output_sram = bytearray([0x00] * 0x80000)
+	used_space = 0
+	output_file = options.file
+	if output_file == options.menu:
+		raise BuildError("Error: The file must not be named {:s}".format(options.menu))
+
+	# Load Menu ROM
+	menu = load_menu(options.menu)
+	layout = None
+	if options.update is not None:
+		if len(options.variants) > 0:
+			raise BuildError("Error: Menu variants can’t be built while updating a compilation")
+		layout = get_compilation_layout(backend, options.update, options.split)
+		output_file = options.update
+		output_sram = layout["sram"]
+	sram_loaded = bytes(output_sram)
+	backend.prepare_build(options, layout)
+	used_space += 0x8000
+
+	# Discover Game ROMs (header only)
+	cache = options.cache if isinstance(options.cache, RomCache) else RomCache(options.cache, backend.app_version)
+	def discover(file):
+		with timings.phase("discovery") as counters:
+			stat = os.stat(file)
+			(found, info) = cache.get(file, stat)
+			if not found:
+				info = discover_rom(backend, file)
+				cache.put(file, stat, info)
+				counters["read"] = min(stat.st_size, 0x200)
+		if info is None: return None
+		# ROMs that the menu can't show are skipped
+		try:
+			return backend.prepare_rom(info)
+		except BuildError as e:
+			return e
+	if options.jobs > 1:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as pool:
+			infos = list(pool.map(discover, rom_sources))
+	else:
+		infos = [ discover(file) for file in rom_sources ]
+	for info in infos:
+		if info is None: continue
+		if isinstance(info, BuildError):
+			logp(str(info))
+			continue
+		info["index"] = len(roms)
+		roms.append(info)
+
+	logp("Found {:d} ROM(s)\n".format(len(roms)))
+	# Re-order loaded ROMs by size
+	roms.sort(key=lambda item: item["size"])
+
+	# Identical ROMs are only placed once
+	unique_roms = find_duplicates(roms, options.jobs, read=not options.plan)
+
+	# Find ROM offsets
+	if layout is not None:
+		(placement, space) = keep_roms(unique_roms, layout, options.jobs, read=not options.plan)
+		logp("Keeping {:d} ROM(s) at their current offsets".format(len(placement)))
+		placement.update(place_roms_greedy([ rom for rom in unique_roms if rom["index"] not in placement ], space))
+		result.packing = { "method":"update", "greedy":get_placement_score(unique_roms, placement), "exact":True }
+	else:
+		placement = place_roms_greedy(unique_roms)
+		result.packing = { "method":"greedy", "greedy":get_placement_score(unique_roms, placement), "exact":True }
+	# A dry run only gets a short search, so planning a compilation stays quick
+	packing_time = min(options.packing_time, plan_packing_time) if options.plan else options.packing_time
+	if options.packing == "optimal" and layout is None:
+		with timings.phase("optimal placement"):
+			(optimal, exact) = place_roms_optimal(unique_roms, result.packing["greedy"], time_budget=packing_time)
+		result.packing["exact"] = exact
+		if optimal is not None:
+			placement = optimal
+			result.packing["method"] = "optimal"
+	result.packing["score"] = get_placement_score(unique_roms, placement)
+
+	# SRAM-enabled ROMs
+	sram_roms_added = 0
+	for rom in roms:
+		if rom["sram_size"] > 0 and "duplicate_of" not in rom:
+			if rom["index"] not in placement:
+				rom["rejected"] = "no SRAM slots are available or it would exceed the maximum size of the compilation"
+				logp("Error: Can’t add {:s} because {:s}".format(rom["title"], rom["rejected"]))
+				result.rejected.append(rom)
+				continue
+			rom["offset"] = placement[rom["index"]]
+			rom_map[rom["index"]] = rom
+			used_space += rom["size"]
+			sram_roms_added += 1
+			sram_slot = math.floor(rom["offset"] / 0x200000)
+			if "kept" in rom: continue
+			buffer_sram = read_rom_sram(rom)
+			if buffer_sram is not None:
+				rom["sram"] = buffer_sram
+				output_sram[sram_slot*0x8000:sram_slot*0x8000+len(rom["sram"])] = rom["sram"]
+			elif layout is not None:
+				# Don't hand the save data of a removed game to a new one
+				output_sram[sram_slot*0x8000:sram_slot*0x8000+0x8000] = bytearray(0x8000)
+	logp("Added {:d} ROM(s) that use SRAM to the compilation".format(sram_roms_added))
+
+	# All other ROMs
+	for rom in roms:
+		if rom["sram_size"] == 0 and "duplicate_of" not in rom:
+			if rom["index"] not in placement:
+				rom["rejected"] = "it exceeds the maximum size of the compilation"
+				logp("Error: Can’t add {:s} (size: 0x{:X}) because {:s}".format(rom["filename"], rom["size"], rom["rejected"]))
+				result.rejected.append(rom)
+				continue
+			rom["offset"] = placement[rom["index"]]
+			rom_map[rom["index"]] = rom
+			used_space += rom["size"]
+	logp("Added {:d} ROM(s) that do not use SRAM to the compilation".format(len(rom_map) - sram_roms_added))
+
+	# Identical ROMs point to the data of their first copy
+	duplicates_added = 0
+	for rom in roms:
+		if "duplicate_of" not in rom: continue
+		original = rom_map.get(rom["duplicate_of"])
+		if original is None:
+			rom["rejected"] = "the ROM it is identical to could not be added"
+			logp("Error: Can’t add {:s} because {:s}".format(rom["filename"], rom["rejected"]))
+			result.rejected.append(rom)
+			continue
+		rom["offset"] = original["offset"]
+		rom_map[rom["index"]] = rom
+		duplicates_added += 1
+		if rom["sram_size"] > 0:
+			sram_slot = math.floor(rom["offset"] / 0x200000)
+			logp("Warning: {:s} is identical to {:s} and will share SRAM slot {:d} with it".format(rom["title"], original["title"], sram_slot))
+			buffer_sram = None if "kept" in original else read_rom_sram(rom)
+			if buffer_sram is None: continue
+			if "sram" in original:
+				logp("Warning: The save data file of {:s} is not used".format(rom["title"]))
+				continue
+			rom["sram"] = buffer_sram
+			output_sram[sram_slot*0x8000:sram_slot*0x8000+len(rom["sram"])] = rom["sram"]
+	if duplicates_added > 0:
+		logp("Added {:d} identical ROM(s) that share the data of another ROM".format(duplicates_added))
+
+	if result.packing["method"] == "optimal":
+		added = result.packing["score"][0] - result.packing["greedy"][0]
+		space_diff = result.packing["score"][1] - result.packing["greedy"][1]
+		if added > 0:
+			logp("Optimized placement fits {:d} more ROM(s) with {:s} {:s} data than the greedy placement".format(added, formatFileSize(abs(space_diff)), "more" if space_diff >= 0 else "less"))
+		else:
+			logp("Optimized placement uses {:s} more space than the greedy placement".format(formatFileSize(space_diff)))
+	if not result.packing["exact"] and options.plan and packing_time < options.packing_time:
+		logp("Note: The placement search of this dry run was stopped after {:.1f} seconds; the actual build searches for up to {:.1f} seconds and may place the ROMs differently.".format(packing_time, options.packing_time))
+	elif not result.packing["exact"]:
+		logp("Note: The placement search was stopped after {:.1f} seconds; the space used may not be optimal.".format(packing_time))
+
+	if len(rom_map) == 0:
+		raise BuildError("\nPlease place ROM files into the “roms” directory.")
+
+	# Patch Menu ROM
+	start = time.perf_counter()
+	(rom_code, rom_size, result.roms) = backend.patch_menu(menu, roms, rom_map, options, now, layout)
+	output_file = output_file.replace("<CODE>", rom_code)
+	created_string = "{:s}".format(now.strftime('%Y-%m-%d %H:%M:%S'))
+	variants = patch_menu_variants(backend, roms, rom_map, options, rom_size, now)
+	timings.add("menu patching", time.perf_counter() - start)
+
+	# Write Output to File(s)
+	logp("\nUsed space: {:s}\nBuild date: {:s}\nROM code: {:s}\n".format(formatFileSize(used_space), now.strftime('%Y-%m-%d %H:%M:%S'), rom_code))
+	for variant in variants:
+		logp("ROM code of the “{:s}” menu variant: {:s}\n".format(variant["name"], variant["result"].rom_code))
+	if options.plan:
+		logp("ROM size: {:s}".format(formatFileSize(rom_size)))
+		if len(result.rejected) > 0:
+			logp("Rejected ROM(s):")
+			for rom in result.rejected: logp("- {:s}".format(rom["filename"]))
+		logp("\nThis was a dry run, the compilation was not written.")
+	else:
+		placed = [ rom for rom in rom_map.values() if "duplicate_of" not in rom ]
+		if layout is not None:
+			written = update_compilation_file(output_file, rom_size, menu, [ rom for rom in placed if "kept" not in rom ], jobs=options.jobs)
+			result.files = [ output_file ]
+			logp("Compilation ROM updated in “{:s}” ({:s} written)".format(output_file, formatFileSize(written)))
+		else:
+			targets = [ (output_file, menu) ] + [ (variant["file"], variant["menu"]) for variant in variants ]
+			files = write_compilation(targets, rom_size, placed, split=options.split, jobs=options.jobs)
+			result.files = files[0]
+			for (variant, variant_files) in zip(variants, files[1:]): variant["result"].files = variant_files
+		if options.split is True:
+			for i in range(0, len(result.files)):
+				logp("Compilation part {:d} saved to “{:s}”".format(i+1, result.files[i]))
+		elif layout is None:
+			logp("Compilation ROM saved to “{:s}”".format(output_file))
+		if output_sram != sram_loaded:
+			fn = os.path.splitext(output_file)[0] + ".sav"
+			with timings.phase("output write", written=len(output_sram)):
+				with open(fn, "wb") as f: f.write(output_sram)
+			result.file_sram = fn
+			logp("Compilation SRAM saved to “{:s}”".format(fn))
+
+		# Menu variants share the ROM data and the save data
+		for variant in variants:
+			for i in range(0, len(variant["result"].files)):
+				if options.split is True:
+					logp("Compilation part {:d} with the “{:s}” menu saved to “{:s}”".format(i+1, variant["name"], variant["result"].files[i]))
+				else:
+					logp("Compilation ROM with the “{:s}” menu saved to “{:s}”".format(variant["name"], variant["result"].files[i]))
+			if output_sram != sram_loaded:
+				fn = os.path.splitext(variant["file"])[0] + ".sav"
+				with timings.phase("output write", written=len(output_sram)):
+					with open(fn, "wb") as f: f.write(output_sram)
+				variant["result"].file_sram = fn
+				logp("Compilation SRAM for the “{:s}” menu saved to “{:s}”".format(variant["name"], fn))
+
+	for rom in roms: cache.update(rom)
+	cache.save()
+	backend.finish_build(options)
+
+	if options.timings:
+		result.timings = timings.stop()
+		logp("\n{:20s} {:>10s} {:>6s} {:>10s} {:>10s} {:>10s} {:>10s}".format("Phase", "Time", "Calls", "Read", "Written", "Max RSS", "Peak traced"))
+		for (name, phase) in result.timings.items():
+			logp("{:20s} {:>8.3f} s {:>6d} {:>10s} {:>10s} {:>10s} {:>10s}".format(name, phase["seconds"], phase["calls"], formatFileSize(phase["read"]), formatFileSize(phase["written"]), formatFileSize(phase["max_rss"]), formatFileSize(phase["peak_traced"])))
+
+	for variant in variants:
+		variant["result"].build_date = created_string
+		variant["result"].used_space = used_space
+		variant["result"].rejected = result.rejected
+		variant["result"].packing = result.packing
+		result.variants.append(variant["result"])
+	result.rom_code = rom_code
+	result.build_date = created_string
+	result.rom_size = rom_size
+	result.used_space = used_space
+	for variant in variants: variant["result"].menu = variant["name"]
+	if options.report is not None:
+		write_build_report(backend, options.report, [ result ])
+	return result
+
+def get_build_report(backend, result):
+	# Everything about a built compilation that other programs may need, as plain JSON types;
+	# ROMs are listed in menu order
+	def get_rom_report(rom):
+		report = { "index":rom["index"], "file":rom["filename"], "title":rom["title"] }
+		if "subtitle" in rom: report["subtitle"] = rom["subtitle"]
+		report.update({ "offset":rom.get("offset"), "size":rom["size"], "file_size":rom["file_size"], "mapper":rom["mapper"], "sram_size":rom["sram_size"] })
+		if "params" in rom: report["params"] = dict(zip(("7000", "7001", "7002", "x"), rom["params"]))
+		if "sram_id" in rom: report["sram_slot"] = rom["sram_id"]
+		if "sram" in rom: report["sram_file"] = "{:s}.sav".format(os.path.splitext(rom["filename"])[0])
+		if "duplicate_of" in rom: report["duplicate_of"] = rom["duplicate_of"]
+		if "rejected" in rom: report["reason"] = rom["rejected"]
+		# SHA-1 of the first 0x200 bytes and of the whole file, and the fixed header checksums
+		report["hashes"] = { name:rom[k].hex() for (k, name) in (("hash", "header_sha1"), ("content_hash", "sha1"), ("checksum", "checksum")) if k in rom }
+		return report
+	return {
+		"builder":"256M ROM Builder",
+		"version":backend.app_version,
+		"menu":result.menu,
+		"files":result.files,
+		"sram_file":result.file_sram,
+		"rom_code":result.rom_code,
+		"build_date":result.build_date,
+		"rom_size":result.rom_size,
+		"used_space":result.used_space,
+		"packing":result.packing,
+		"roms":[ get_rom_report(rom) for rom in result.roms ],
+		"rejected":[ get_rom_report(rom) for rom in result.rejected ],
+		"variants":[ get_build_report(backend, variant) for variant in result.variants ],
+	}
+
+def write_build_report(backend, file, results):
+	# A JSON Lines file gets one line per compilation appended, any other file is replaced
+	reports = [ get_build_report(backend, result) for result in results ]
+	if os.path.splitext(file)[1].lower() == ".jsonl":
+		with open(file, "a", encoding="utf-8") as f: f.write("".join(json.dumps(report, ensure_ascii=False) + "\n" for report in reports))
+	else:
+		write_file_atomic(file, json.dumps({ "compilations":reports }, ensure_ascii=False, indent="\t").encode("UTF-8"))
+	logp("Build report saved to “{:s}”".format(file))
+
+##############################
+# ROM/SRAM Export/Import
+
+def check_compilation(compilation):
+	menu_version = compilation[0x14C]
+	if menu_version < 1:
+		raise BuildError("Error: This Compilation ROM version is too old.")
+	signature = compilation[0x150:0x165].decode("ascii", "ignore")
+	if signature != "256M ROM Builderby LK":
+		raise BuildError("Error: Not a valid Compilation ROM. Please merge any split ROMs first.")
+
+def get_compilation_layout(backend, file_compilation, split=False):
+	# Reads only the menu bank and the ROM headers of a compilation that gets updated in place
+	if split:
+		raise BuildError("Error: Split compilations can’t be updated. Please merge them first.")
+	if not os.path.exists(file_compilation):
+		raise BuildError("Error: Compilation ROM file not found!")
+	with open(file_compilation, "rb") as f:
+		compilation = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+		check_compilation(compilation)
+		# A part of a split compilation or a cut-off file would be grown with ROMs that are
+		# already in the other parts, and its global checksum doesn't belong to the file
+		if len(compilation) != 0x8000 << compilation[0x148]:
+			raise BuildError("Error: The size of the compilation doesn’t match its header. Split compilations must be merged before they can be updated.")
+		layout = {}
+		layout["menu"] = bytearray(compilation[0:0x8000])
+		layout["size"] = len(compilation)
+		layout["rom_code"] = compilation[0x13F:0x143].decode("ascii", "ignore")
+		layout["entries"] = get_compilation_entries(backend, compilation, file_compilation)
+		for entry in layout["entries"]:
+			if entry["offset"] + entry["size"] > len(compilation):
+				raise BuildError("Error: {:s} is cut off at the end of the compilation, so it can’t be updated.".format(entry["title"]))
+			header = compilation[entry["offset"]:entry["offset"]+0x200]
+			entry["header_key"] = get_header_key(header)
+			entry["checksum"] = bytes(header[0x14D:0x150])
+	finally:
+		compilation.close()
+
+	layout["sram"] = bytearray([0x00] * 0x80000)
+	file_sram = os.path.splitext(file_compilation)[0] + ".sav"
+	if os.path.exists(file_sram):
+		with open(file_sram, "rb") as f: sram = bytearray(f.read())
+		if len(sram) == 0x80000: layout["sram"] = sram
+	logp("Updating {:s} with ROM code {:s}\n".format(file_compilation, layout["rom_code"]))
+	return layout
+
+def load_compilation(file_compilation, create_sram=False, mapped=False):
+	# With `mapped`, both files are memory-mapped read-only and must be closed by the caller
+	fn = os.path.splitext(file_compilation)[0]
+	file_sram = "{:s}.sav".format(fn)
+	sram = None
+
+	# Load files
+	if not os.path.exists(file_compilation):
+		raise BuildError("Error: Compilation ROM file not found!")
+	with open(file_compilation, "rb") as f:
+		if mapped:
+			if os.fstat(f.fileno()).st_size < 0x8000:
+				raise BuildError("Error: Not a valid Compilation ROM. Please merge any split ROMs first.")
+			compilation = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		else:
+			compilation = bytearray(f.read())
+
+	check_compilation(compilation)
+	menu_version = compilation[0x14C]
+	build_date = compilation[0x168:0x17B].decode("ascii", "ignore")
+	rom_code = compilation[0x13F:0x143].decode("ascii", "ignore")
+	logp("Compilation ROM loaded.")
+	logp("\nMenu Version: {:d}\nBuild date: {:s}\nROM code: {:s}".format(menu_version, build_date, rom_code))
+
+	if os.path.exists(file_sram):
+		with open(file_sram, "rb") as f:
+			if os.fstat(f.fileno()).st_size != 0x80000:
+				raise BuildError("Error: The compilation SRAM file must be 512 KB.")
+			if mapped:
+				sram = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			else:
+				sram = bytearray(f.read())
+	elif create_sram:
+		sram = bytearray(0x80000)
+	else:
+		logp("SRAM file not found.")
+
+	return (compilation, sram, file_sram)
+
+def get_compilation_entries(backend, compilation, file_compilation):
+	# The game list is read from the menu of `backend`
+	dir = os.path.splitext(file_compilation)[0]
+	entries = []
+	for c in range(0, compilation[backend.addr_num_items]):
+		pos = backend.addr_menu_text + (c * 16)
+		data = {}
+		if compilation[pos:pos+16] == bytearray([0xFF] * 16): break
+		data["index"] = c
+		data["title"] = compilation[pos:pos+16].decode("ascii", "ignore").strip()
+		pos = backend.addr_menu_param + (c * 4)
+		x = compilation[pos+0]
+		v7002 = compilation[pos+1]
+		v7001 = compilation[pos+2]
+		v7000 = compilation[pos+3]
+		data["offset"] = (v7000 * 0x8000) + ((v7002 & 0b11) * 0x800000)
+		size = [k for (k, v) in v7001_values.items() if v == v7001]
+		if len(size) != 1: continue
+		data["size"] = size[0]
+		if (v7002 & 0xF0 >> 2) == 0x10:
+			data["sram_id"] = math.floor(data["offset"] / 0x200000)
+
+		no_sram = ""
+		if data["offset"] >= len(compilation):
+			logp("{:s} not found inside {:s}.".format(data["title"], file_compilation))
+			continue
+		buffer = compilation[data["offset"]:data["offset"]+0x150]
+		sram_size = get_sram_size(buffer)
+		if buffer[0x143] in (0xC0, 0x80):
+			ext = ".gbc"
+		elif buffer[0x146] == 0x03:
+			ext = ".sgb"
+		else:
+			ext = ".gb"
+		if "sram_id" in data:
+			data["sram_size"] = sram_size
+			data["sram_address"] = data["sram_id"] * 0x8000
+		elif sram_size > 0:
+			no_sram = "#"
+
+		data["sram_file"] = "{:s}/#{:03d} {:s}.sav".format(dir, data["index"]+1, data["title"])
+		data["rom_file"] = "{:s}/#{:03d} {:s}{:s}{:s}".format(dir, data["index"]+1, data["title"], no_sram, ext)
+		entries.append(data)
+	return entries
+
+def write_file_atomic(file, buffer):
+	# The file is either fully replaced or left as it was
+	with open(file + ".tmp", "wb") as f:
+		f.write(buffer)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(file + ".tmp", file)
+
+def write_file_slice(file, buffer, offset, size):
+	# Writes a part of a buffer or memory-mapped file without copying it first
+	with memoryview(buffer) as view:
+		with open(file, "wb") as f: f.write(view[offset:offset+size])
+
+@logged
+def export_compilation(backend, file_compilation, options=None):
+	result = BuildResult(backend.menu_backend)
+	jobs = 1 if options is None else max(1, options.jobs)
+	(compilation, sram, _) = load_compilation(file_compilation, mapped=True)
+	dir = os.path.splitext(file_compilation)[0]
+	print("")
+	try:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+			futures = []
+			for data in get_compilation_entries(backend, compilation, file_compilation):
+				if not os.path.exists(dir): os.mkdir(dir)
+				logp("Exporting ROM #{:d} to “{:s}”".format(data["index"]+1, data["rom_file"]))
+				futures.append(pool.submit(write_file_slice, data["rom_file"], compilation, data["offset"], data["size"]))
+				result.files.append(data["rom_file"])
+				result.roms.append(data)
+				if sram is not None and "sram_id" in data:
+					logp("Exporting SRAM #{:d} to “{:s}”".format(data["sram_id"], data["sram_file"]))
+					futures.append(pool.submit(write_file_slice, data["sram_file"], sram, data["sram_address"], data["sram_size"]))
+					result.files.append(data["sram_file"])
+			for future in futures: future.result()
+	finally:
+		compilation.close()
+		if sram is not None: sram.close()
+	return result
+
+@logged
+def import_sram(backend, file_compilation, options=None):
+	result = BuildResult(backend.menu_backend)
+	(compilation, sram, file_sram) = load_compilation(file_compilation, create_sram=True)
+	dir = os.path.splitext(file_compilation)[0]
+	if not os.path.exists(dir):
+		raise BuildError("Error: No files found for importing!")
+	print("")
+	changed = not os.path.exists(file_sram)
+	for data in get_compilation_entries(backend, compilation, file_compilation):
+		if "sram_id" not in data: continue
+		if not os.path.exists(data["sram_file"]): continue
+		with open(data["sram_file"], "rb") as f: sram_game = f.read(data["sram_size"])
+		pos = data["sram_address"]
+		result.roms.append(data)
+		if sram[pos:pos+len(sram_game)] == sram_game:
+			logp("Skipping “{:s}” because SRAM #{:d} is unchanged".format(data["sram_file"], data["sram_id"]))
+			continue
+		sram[pos:pos+len(sram_game)] = sram_game
+		changed = True
+		logp("Importing “{:s}” into SRAM #{:d}".format(data["sram_file"], data["sram_id"]))
+
+	# All slots are written at once
+	if len(result.roms) > 0:
+		if changed: write_file_atomic(file_sram, sram)
+		result.file_sram = file_sram
+	return result
+
+def get_slice_hash(buffer, offset, size, file_size=None):
+	# SHA-1 of a ROM without its header and global checksums, which are fixed when the ROM is
+	# added; a trimmed ROM is hashed as if it was padded with 0xFF to its full size
+	if file_size is None: file_size = size
+	file_size = min(file_size, size)
+	with memoryview(buffer) as view:
+		hash = hashlib.sha1(view[offset:offset+0x14D])
+		hash.update(view[offset+0x150:offset+file_size])
+	for i in range(file_size, size, 0x10000):
+		hash.update(b"\xFF" * min(0x10000, size - i))
+	return hash.digest()
+
+def get_source_hash(info):
+	with open(info["filename"], "rb") as f:
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+			return get_slice_hash(buffer, 0, info["size"], len(buffer))
+
+def get_compilation_metadata(compilation):
+	# Records that the builder keeps at 0x1000 for every ROM that uses SRAM, by offset
+	records = {}
+	for c in range(0, 16):
+		pos = 0x1000 + (c * 0x20)
+		(index, offset, size, sram_size, sram_id, hash) = struct.unpack("=HIIIH16s", compilation[pos:pos+0x20])
+		if index == 0xFFFF: break
+		records[offset] = { "index":index, "offset":offset, "size":size, "sram_size":sram_size, "sram_id":sram_id, "hash":hash }
+	return records
+
+@logged
+def verify_compilation(backend, file_compilation, rom_sources=None, options=None):
+	# Checks the checksums of a compilation and of every ROM inside it while reading the file only
+	# once; with `rom_sources`, every ROM is also compared with its source file by hash
+	result = BuildResult(backend.menu_backend)
+	jobs = 1 if options is None else max(1, options.jobs)
+	(compilation, sram, _) = load_compilation(file_compilation, mapped=True)
+	if sram is not None: sram.close()
+	failed = 0
+	try:
+		entries = get_compilation_entries(backend, compilation, file_compilation)
+		if len(entries) == 0:
+			raise BuildError("Error: No ROMs were found in the menu of the compilation.")
+		records = get_compilation_metadata(compilation)
+		result.files = [ file_compilation ]
+		result.rom_code = compilation[0x13F:0x143].decode("ascii", "ignore")
+		result.build_date = compilation[0x168:0x17B].decode("ascii", "ignore")
+		result.rom_size = len(compilation)
+
+		# Source ROMs are matched with the ROMs inside the compilation by size and header
+		sources = {}
+		if rom_sources is not None:
+			cache = RomCache(None) if options is None else options.cache if isinstance(options.cache, RomCache) else RomCache(options.cache, backend.app_version)
+			def discover(file):
+				stat = os.stat(file)
+				(found, info) = cache.get(file, stat)
+				if not found:
+					info = discover_rom(backend, file)
+					cache.put(file, stat, info)
+				return info
+			with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+				infos = [ info for info in pool.map(discover, rom_sources) if info is not None ]
+			cache.save()
+			for info in infos:
+				sources.setdefault((info["size"], get_header_key(info["header"])), []).append(info)
+			logp("\nVerifying {:d} ROM(s) against {:d} source ROM(s)\n".format(len(entries), len(infos)))
+		else:
+			logp("\nVerifying {:d} ROM(s)\n".format(len(entries)))
+
+		# Hashes are calculated by the worker pool while it adds up the bytes of every 32 KB bank
+		slice_hashes = {}
+		source_hashes = {}
+		with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+			for entry in entries:
+				if entry["offset"] + entry["size"] > len(compilation): continue
+				entry["header_key"] = get_header_key(compilation[entry["offset"]:entry["offset"]+0x200])
+				matches = sources.get((entry["size"], entry["header_key"]), [])
+				if len(matches) > 0 and entry["offset"] not in slice_hashes:
+					slice_hashes[entry["offset"]] = pool.submit(get_slice_hash, compilation, entry["offset"], entry["size"])
+				for info in matches:
+					if info["filename"] not in source_hashes:
+						source_hashes[info["filename"]] = pool.submit(get_source_hash, info)
+			bank_sums = list(pool.map(lambda offset: get_byte_sum(compilation[offset:offset+0x8000]), range(0, len(compilation), 0x8000)))
+			slice_hashes = { k:v.result() for (k, v) in slice_hashes.items() }
+			source_hashes = { k:v.result() for (k, v) in source_hashes.items() }
+
+		header = compilation[0:0x150]
+		checksum = (sum(bank_sums) - header[0x14E] - header[0x14F]) & 0xFFFF
+		header_ok = FixHeaderChecksum(bytearray(header))[0x14D] == header[0x14D]
+		checksum_ok = checksum == (header[0x14E] << 8 | header[0x14F])
+		size_ok = len(compilation) == 0x8000 << header[0x148]
+		logp("Header checksum: {:s}".format("OK" if header_ok else "Invalid"))
+		logp("Global checksum: {:s}".format("OK" if checksum_ok else "Invalid (should be 0x{:04X})".format(checksum)))
+		logp("ROM size: {:s}\n".format(formatFileSize(len(compilation)) if size_ok else "Doesn’t match the header"))
+		failed += [ header_ok, checksum_ok, size_ok ].count(False)
+
+		used = set()
+		for entry in entries:
+			problems = []
+			(offset, size) = (entry["offset"], entry["size"])
+			record = records.get(offset)
+			if offset + size > len(compilation):
+				problems.append("the ROM is cut off at the end of the file")
+			else:
+				header = compilation[offset:offset+0x150]
+				if FixHeaderChecksum(bytearray(header))[0x14D] != header[0x14D]:
+					problems.append("invalid header checksum")
+				checksum = (sum(bank_sums[offset//0x8000:(offset+size)//0x8000]) - header[0x14E] - header[0x14F]) & 0xFFFF
+				if checksum != (header[0x14E] << 8 | header[0x14F]):
+					problems.append("invalid global checksum")
+			if "sram_id" in entry and (record is None or record["size"] != size or record["sram_id"] != entry["sram_id"]):
+				problems.append("no matching SRAM metadata")
+			if rom_sources is not None and "header_key" in entry:
+				matches = sources.get((size, entry["header_key"]), [])
+				same = [ info for info in matches if source_hashes[info["filename"]] == slice_hashes[offset] ]
+				same.sort(key=lambda info: (info["title"] != entry["title"], info["filename"] in used))
+				if len(matches) == 0:
+					problems.append("no source ROM found")
+				elif len(same) == 0:
+					problems.append("differs from “{:s}”".format(matches[0]["filename"]))
+					used.add(matches[0]["filename"])
+				else:
+					entry["source"] = same[0]["filename"]
+					used.add(entry["source"])
+					if record is not None and record["hash"] != same[0]["hash"][:16]:
+						problems.append("SRAM metadata belongs to another ROM")
+			if len(problems) > 0:
+				entry["problems"] = problems
+				result.rejected.append(entry)
+				logp("#{:03d} {:16s} Error: {:s}".format(entry["index"]+1, entry["title"], ", ".join(problems)))
+			elif "source" in entry:
+				logp("#{:03d} {:16s} OK (“{:s}”)".format(entry["index"]+1, entry["title"], entry["source"]))
+			else:
+				logp("#{:03d} {:16s} OK".format(entry["index"]+1, entry["title"]))
+			result.roms.append(entry)
+		failed += len(result.rejected)
+
+		if rom_sources is not None:
+			unused = [ info["filename"] for group in sources.values() for info in group if info["filename"] not in used ]
+			if len(unused) > 0:
+				logp("\nNote: {:d} source ROM(s) are not inside the compilation:".format(len(unused)))
+				for file in sorted(unused): logp("- {:s}".format(file))
+	finally:
+		compilation.close()
+
+	if failed > 0:
+		raise BuildError("\nError: The compilation failed verification with {:d} problem(s).".format(failed))
+	logp("\nThe compilation and all {:d} ROM(s) inside it are OK.".format(len(result.roms)))
+	return result
+
+##############################
+# Batch Builds
+
+def load_manifest(file_manifest):
+	if not os.path.exists(file_manifest):
+		raise BuildError("Error: Manifest file not found!")
+	try:
+		if os.path.splitext(file_manifest)[1].lower() == ".toml":
+			try:
+				import tomllib
+			except ImportError:
+				raise BuildError("Error: TOML manifests require Python 3.11 or newer. Please use a JSON manifest instead.")
+			with open(file_manifest, "rb") as f: manifest = tomllib.load(f)
+		else:
+			with open(file_manifest, "r", encoding="utf-8") as f: manifest = json.load(f)
+	except ValueError as e:
+		raise BuildError("Error: The manifest file could not be read. {:s}".format(str(e)))
+	if not isinstance(manifest, dict) or not isinstance(manifest.get("compilations"), list) or len(manifest["compilations"]) == 0:
+		raise BuildError("Error: The manifest file must contain a list of compilations.")
+	return manifest
+
+def get_manifest_builds(backend, manifest, options):
+	# Returns the ROM files and build options of every compilation in a manifest; ROMs are
+	# selected from the shared library directory by file name or wildcard pattern
+	sources = get_rom_sources(manifest.get("library", default_roms_dir))
+	builds = []
+	for entry in manifest["compilations"]:
+		settings = dict(manifest.get("defaults", {}))
+		settings.update(entry)
+		if "file" not in settings:
+			raise BuildError("Error: Every compilation in the manifest needs a file name.")
+		patterns = settings.pop("roms", [ "*" ])
+		if isinstance(patterns, str): patterns = [ patterns ]
+		build_options = backend.BuildOptions(**vars(options))
+		for (k, v) in settings.items():
+			if k not in backend.manifest_settings:
+				raise BuildError("Error: Unknown setting “{:s}” for “{:s}” in the manifest.".format(k, settings["file"]))
+			setattr(build_options, k, v)
+		if build_options.toc not in ("index", "offset", "hide") or build_options.packing not in ("optimal", "greedy"):
+			raise BuildError("Error: Invalid TOC or packing setting for “{:s}” in the manifest.".format(settings["file"]))
+		files = []
+		for pattern in patterns:
+			matches = [ file for file in sources if os.path.basename(file) == pattern or fnmatch.fnmatch(os.path.basename(file), pattern) ]
+			if len(matches) == 0:
+				raise BuildError("Error: No ROM file matches “{:s}” for “{:s}” in the manifest.".format(pattern, settings["file"]))
+			files += [ file for file in matches if file not in files ]
+		files.sort()
+		builds.append((files, build_options))
+	return builds
+
+def build_manifest_entry(rom_sources, options):
+	# Runs in a worker process; the output is returned with the result and logged by the caller
+	# instead of being written to the log file. The menu backend is the builder module that the
+	# options belong to.
+	global log_stream
+	backend = sys.modules[type(options).__module__]
+	log_stream = None
+	with capture_log() as lines, contextlib.redirect_stdout(io.StringIO()):
+		try:
+			result = build_compilation(backend, rom_sources, options)
+		except BuildError as e:
+			result = e
+	return ("".join(lines), result)
+
+def build_manifest(backend, file_manifest, options=None):
+	if options is None: options = backend.BuildOptions()
+	builds = get_manifest_builds(backend, load_manifest(file_manifest), options)
+	logp("Building {:d} compilation(s) from “{:s}”".format(len(builds), file_manifest))
+
+	# All ROM headers are read once and shared by every compilation
+	cache = RomCache(options.cache, backend.app_version)
+	def discover(file):
+		stat = os.stat(file)
+		if not cache.get(file, stat)[0]: cache.put(file, stat, discover_rom(backend, file))
+	files = sorted(set(file for (rom_sources, _) in builds for file in rom_sources))
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, options.jobs)) as pool:
+		list(pool.map(discover, files))
+	shared = RomCache()
+	shared.records = cache.records
+	workers = max(1, min(options.jobs, len(builds)))
+	for (_, build_options) in builds:
+		build_options.cache = shared
+		build_options.report = None
+		build_options.jobs = max(1, options.jobs // workers)
+
+	results = []
+	if workers > 1:
+		# Worker processes must not inherit lines that are still buffered for the log file
+		if log_stream is not None: log_stream.flush()
+		with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+			outputs = pool.map(build_manifest_entry, *zip(*builds))
+			for (i, (output, result)) in enumerate(outputs):
+				logp("\n[{:d}/{:d}] {:s}\n".format(i+1, len(builds), builds[i][1].file))
+				for line in output.splitlines(): logp(line)
+				if isinstance(result, BuildError): logp(str(result))
+				results.append(result)
+	else:
+		for (i, (rom_sources, build_options)) in enumerate(builds):
+			logp("\n[{:d}/{:d}] {:s}\n".format(i+1, len(builds), build_options.file))
+			try:
+				result = build_compilation(backend, rom_sources, build_options)
+			except BuildError as e:
+				logp(str(e))
+				result = e
+			results.append(result)
+
+	failed = 0
+	for result in results:
+		if isinstance(result, BuildError):
+			failed += 1
+			continue
+		for rom in result.roms: cache.update(rom)
+	cache.save()
+	if options.report is not None:
+		write_build_report(backend, options.report, [ result for result in results if not isinstance(result, BuildError) ])
+	if failed > 0:
+		raise BuildError("\nError: {:d} of {:d} compilation(s) could not be built.".format(failed, len(builds)))
+	logp("\nAll {:d} compilation(s) were built.".format(len(builds)))
+	return results
+
+################################
+# Watch Mode
+
+class FileWatcher:
+	# Reports files of the watched directories and files that were added, removed or modified;
+	# on Linux, inotify wakes it up, elsewhere the paths are polled
+	events = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 # IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE
+
+	def __init__(self, paths, interval=0.5, settle=0.2):
+		self.paths = paths
+		self.interval = interval
+		self.settle = settle
+		self.fd = None
+		self.files = self.scan()
+		if not sys.platform.startswith("linux"): return
+		try:
+			import ctypes, ctypes.util
+			libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+			fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		except (OSError, AttributeError):
+			return
+		if fd < 0: return
+		for path in paths:
+			libc.inotify_add_watch(fd, os.fsencode(path if os.path.isdir(path) else os.path.dirname(path) or "."), self.events)
+		self.fd = fd
+
+	def scan(self):
+		files = {}
+		for path in self.paths:
+			try:
+				if os.path.isdir(path):
+					for entry in os.scandir(path):
+						if entry.is_file():
+							stat = entry.stat()
+							files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+				elif os.path.exists(path):
+					stat = os.stat(path)
+					files[path] = (stat.st_size, stat.st_mtime_ns)
+			except OSError:
+				pass
+		return files
+
+	def drain(self):
+		if self.fd is None: return
+		try:
+			while len(os.read(self.fd, 0x10000)) > 0: pass
+		except BlockingIOError:
+			pass
+
+	def wait(self):
+		# Blocks until files have changed and stopped changing, then returns their paths
+		while True:
+			if self.fd is None:
+				time.sleep(self.interval)
+			elif len(select.select([ self.fd ], [], [], self.interval * 10)[0]) > 0:
+				self.drain()
+			files = self.scan()
+			if files == self.files: continue
+			# Files that are still being copied are waited for
+			while True:
+				time.sleep(self.settle)
+				self.drain()
+				settled = self.scan()
+				if settled == files: break
+				files = settled
+			changed = sorted(file for file in set(files) | set(self.files) if files.get(file) != self.files.get(file))
+			self.files = files
+			if len(changed) > 0: return changed
+
+	def close(self):
+		if self.fd is not None: os.close(self.fd)
+		self.fd = None
+
+def watch_compilation(backend, options=None, path=default_roms_dir):
+	# Rebuilds the compilation whenever the ROM directory changes. ROM headers and checksums stay
+	# in memory, so only new or changed files are read again, and ROMs that are already in the
+	# compilation keep their offsets unless save data changed or a new ROM doesn't fit anymore.
+	if options is None: options = backend.BuildOptions()
+	options = backend.BuildOptions(**vars(options))
+	if not isinstance(options.cache, RomCache): options.cache = RomCache(options.cache, backend.app_version)
+	output_file = options.update
+	if output_file is not None: options.file = output_file
+	watcher = FileWatcher([ path ] + backend.get_input_files(options))
+	changed = []
+	rejected = set()
+	try:
+		while True:
+			build_options = backend.BuildOptions(**vars(options))
+			build_options.update = None
+			if output_file is not None and os.path.exists(output_file) and not options.split and not options.plan and len(options.variants) == 0 and not any(file.lower().endswith(".sav") for file in changed):
+				build_options.update = output_file
+			start = time.perf_counter()
+			try:
+				result = build_compilation(backend, get_rom_sources(path), build_options)
+				if build_options.update is not None and any(rom["filename"] not in rejected for rom in result.rejected):
+					logp("\nRebuilding the whole compilation to make room for the new ROM(s)\n")
+					build_options.update = None
+					result = build_compilation(backend, get_rom_sources(path), build_options)
+				if output_file is None:
+					output_file = options.file.replace("<CODE>", result.rom_code)
+					options.file = output_file
+				rejected = set(rom["filename"] for rom in result.rejected)
+				logp("\nBuilt in {:.2f} seconds".format(time.perf_counter() - start))
+			except BuildError as e:
+				logp(str(e))
+			logp("\nWatching “{:s}” for changes. Press Ctrl+C to stop.".format(path))
+			changed = watcher.wait()
+			logp("\n{:d} file(s) changed:".format(len(changed)))
+			for file in changed: logp("- {:s}".format(file))
+			logp("")
+	except KeyboardInterrupt:
+		pass
+	finally:
+		watcher.close()
+
+################################
+
+def main(backend):
+	global log_stream
+	print("")
+	with capture_log() as header:
+		logp("256M ROM Builder v{:s}\nby Lesserkuma\n".format(backend.app_version))
+	variants = [ name for name in menu_backends if name != backend.menu_backend ]
+	parser = argparse.ArgumentParser()
+	backend.add_arguments(parser)
+	parser.add_argument("--split", help="splits output files into 8 MB parts", action="store_true", default=False)
+	parser.add_argument("--toc", help="changes the order of the table of contents", choices=["index", "offset", "hide"], type=str.lower, default="index")
+	parser.add_argument("--packing", help="sets how ROMs are arranged; “optimal” searches for an arrangement that fits more ROMs than the simple greedy one", choices=["optimal", "greedy"], type=str.lower, default="optimal")
+	parser.add_argument("--jobs", help="sets how many ROM files are read at the same time", type=int, default=os.cpu_count() or 1)
+	parser.add_argument("--cache", help="sets the file that keeps ROM headers and checksums between runs", type=str, default=backend.default_cache_file)
+	parser.add_argument("--no-cache", help="don’t read or write the {:s}".format(backend.cache_files), action="store_true", default=False)
+	parser.add_argument("--no-wait", help="don’t wait for user input when finished", action="store_true", default=False)
+	parser.add_argument("--no-log", help="don’t write a log file", action="store_true", default=False)
+	parser.add_argument("--variant", help="also builds the compilation with the {:s} menu from the same ROM placement".format(" or ".join(menu_names[name] for name in variants)), choices=variants, type=str.lower, action="append", dest="variants", default=[])
+	parser.add_argument("--timings", help="prints the time, bytes read and written and memory use of every build phase", action="store_true", default=False)
+	parser.add_argument("--report", help="writes a JSON report of the compilation with the offset, parameters, SRAM slot and hashes of every ROM; a .jsonl file gets one line per build appended", type=str, default=None)
+	parser.add_argument("--plan", help="only prints the layout of the compilation without reading ROM data or writing any files", action="store_true", default=False)
+	parser.add_argument("--update", help="updates an existing compilation in place; ROMs that are still there keep their offsets", action="store_true", default=False)
+	parser.add_argument("--watch", help="keeps running and rebuilds the compilation whenever files in the roms directory change", action="store_true", default=False)
+	parser.add_argument("--manifest", help="builds every compilation listed in a JSON or TOML manifest file", type=str, default=None)
+	parser.add_argument("--export-all", help="export individual SRAM files and ROM files from an existing compilation", action="store_true", default=False)
+	parser.add_argument("--verify", help="checks the checksums of an existing compilation and of every ROM inside it", action="store_true", default=False)
+	parser.add_argument("--roms", help="sets the directory with the source ROMs that --verify compares the compilation with", type=str, default=None)
+	parser.add_argument("--import-sram", help="import individual SRAM files into a 512 KB SRAM compilation file", action="store_true", default=False)
+	parser.add_argument("file", help="sets the file name of the compilation ROM", nargs='?', default=default_file)
+	args = parser.parse_args()
+	options = backend.BuildOptions(**vars(args))
+	if args.no_cache:
+		for k in backend.cache_options: setattr(options, k, None)
+	options.update = args.file if args.update else None
+
+	# Lines go to the buffered log file as they are logged, so a long watch session keeps nothing
+	# in memory
+	if not args.no_log:
+		log_stream = open("log.txt", "a", encoding="utf-8")
+		log_stream.write("".join(header))
+	failed = False
+	try:
+		if args.manifest is not None:
+			build_manifest(backend, args.manifest, options)
+		elif args.verify:
+			if args.file == default_file:
+				parser.print_help()
+				raise BuildError("\nError: Compilation ROM file must be set via command line argument!")
+			verify_compilation(backend, args.file, None if args.roms is None else get_rom_sources(args.roms), options)
+		elif args.export_all is False and args.import_sram is False:
+			if args.update and args.file == default_file:
+				parser.print_help()
+				raise BuildError("\nError: Compilation ROM file must be set via command line argument!")
+			if args.watch:
+				watch_compilation(backend, options)
+			else:
+				build_compilation(backend, get_rom_sources(), options)
+		else:
+			if args.file == default_file:
+				parser.print_help()
+				raise BuildError("\nError: Compilation ROM file must be set via command line argument!")
+			if args.file == backend.default_menu_file:
+				raise BuildError("Error: The file must not be named {:s}".format(backend.default_menu_file))
+			dir = os.path.splitext(args.file)[0]
+			if args.import_sram and os.path.exists(args.file) and not os.path.exists(dir):
+				logp("Error: No files found for importing!\nWill now instead export files to the “{:s}” directory.\nYou can then replace the individual .sav files and run the import again.".format(dir))
+				args.export_all = True
+				args.import_sram = False
+				try:
+					input("\nPress ENTER to continue or Ctrl+C to cancel.\n")
+				except KeyboardInterrupt:
+					sys.exit(0)
+			if args.export_all:
+				export_compilation(backend, args.file, options)
+			else:
+				import_sram(backend, args.file, options)
+	except BuildError as e:
+		logp(str(e))
+		failed = True
+	finally:
+		if log_stream is not None:
+			log_stream.write("\nArgument List: {:s}\n".format(str(sys.argv[1:])))
+			log_stream.write("\n################################\n\n")
+			log_stream.close()
+			log_stream = None
+
+	if not args.no_wait: input("\nPress ENTER to exit.\n")
+	if failed: sys.exit(1)
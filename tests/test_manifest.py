@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# 256M ROM Builder
+# Author: Lesserkuma (github.com/lesserkuma)
+#
+# Builds compilations from manifests whose ROM library is given as an absolute path.
+
+import os, sys, io, json, importlib, contextlib
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+builder = importlib.import_module("256m_rom_builder")
+benchmark = importlib.import_module("benchmark")
+
+################################
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+	# A few small ROMs in a library outside of the working directory
+	path = tmp_path / "library"
+	path.mkdir()
+	for i in range(0, 6):
+		benchmark.make_rom(str(path / "game{:02d}.gb".format(i)), 0x8000 << (i % 3), "GAME{:02d}".format(i), sram=2 if i == 0 else 0, seed=i)
+	work_dir = tmp_path / "work"
+	work_dir.mkdir()
+	monkeypatch.chdir(work_dir)
+	return str(path)
+
+def write_manifest(library, compilations):
+	with open("sets.json", "w", encoding="utf-8") as f:
+		json.dump({ "library":library, "defaults":{ "packing":"greedy" }, "compilations":compilations }, f)
+	return "sets.json"
+
+def test_manifest_builds_absolute_library(library):
+	assert os.path.isabs(library)
+	manifest = builder.core.load_manifest(write_manifest(library, [ { "file":"A.gbc", "roms":[ "game0[0-2].gb" ] }, { "file":"B.gbc" } ]))
+	builds = builder.core.get_manifest_builds(builder, manifest, builder.BuildOptions())
+	assert [ [ os.path.basename(file) for file in files ] for (files, _) in builds ] == [ [ "game00.gb", "game01.gb", "game02.gb" ], [ "game{:02d}.gb".format(i) for i in range(0, 6) ] ]
+	assert all(os.path.dirname(file) == library for (files, _) in builds for file in files)
+
+@pytest.mark.parametrize("jobs", [ 1, 2 ])
+def test_build_manifest_absolute_library(library, jobs):
+	file_manifest = write_manifest(library, [ { "file":"A.gbc", "roms":[ "game00.gb", "game03.gb" ], "title":"SET A" }, { "file":"B.gbc", "roms":"*" } ])
+	options = builder.BuildOptions(menu=os.path.join(repo_dir, builder.default_menu_file), cache=None, jobs=jobs)
+	with contextlib.redirect_stdout(io.StringIO()):
+		results = builder.build_manifest(file_manifest, options)
+	assert [ result.files for result in results ] == [ [ "A.gbc" ], [ "B.gbc" ] ]
+	assert [ len(result.roms) for result in results ] == [ 2, 6 ]
+	for result in results:
+		assert all(os.path.dirname(rom["filename"]) == library for rom in result.roms)
+		assert os.path.getsize(result.files[0]) == result.rom_size
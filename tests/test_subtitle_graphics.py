@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# 256M ROM Builder
+# Author: Lesserkuma (github.com/lesserkuma)
+#
+# Compares the subtitle and title graphics conversion of the Chinese builder with the
+# per-pixel versions it replaced.
+
+import os, sys, random, importlib
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+builder = importlib.import_module("256m_rom_builder_cn")
+
+################################
+
+def img2glyph_reference(img):
+	data = [ img.getpixel((x, y)) for y in range(0, img.height) for x in range(0, img.width) ]
+	output_data = bytearray()
+	tile_order = [0, 2, 1, 3]
+	for order in tile_order:
+		tile_x = order % 2
+		tile_y = order // 2
+		for y in range(8):
+			byte = 0
+			for bit in range(8):
+				i = ((tile_y * 8 + y) * 16) + (tile_x * 8) + bit
+				if data[i]:
+					byte |= (0 << (7 - bit))
+				else:
+					byte |= (1 << (7 - bit))
+			output_data.append(byte)
+	return output_data
+
+def img2title_reference(img):
+	tiles = [ [0] * 0x10 ]
+	map = []
+	for by in range(0, img.height, 8):
+		for bx in range(0, img.width, 8):
+			block = bytearray(16)
+			for y in range(8):
+				for x in range(8):
+					value = img.getpixel((bx + x, by + y))
+					block[y * 2] |= (value & 2) >> 1 << (7 - x)
+					block[y * 2 + 1] |= (value & 1) << (7 - x)
+			tile = list(block)
+			if tile in tiles:
+				map.append(tiles.index(tile))
+			else:
+				if len(tiles) >= 0x23:
+					map.append(0)
+				else:
+					map.append(len(tiles))
+				tiles.extend([ tile ])
+	output_data = bytearray([item for sublist in tiles for item in sublist])
+	if len(output_data) < 0x230:
+		output_data += bytearray([0] * (0x230 - len(output_data)))
+	if len(output_data) > 0x230:
+		output_data = output_data[:0x230]
+	return (output_data, map)
+
+def random_pixels(size, values, seed):
+	rng = random.Random(seed)
+	return [ rng.choice(values) for i in range(0, size[0] * size[1]) ]
+
+def glyph_image(size, seed):
+	img = Image.new("1", size)
+	img.putdata(random_pixels(size, [ 0, 255 ], seed))
+	return img
+
+def indexed_image(data, size):
+	img = Image.new("P", size)
+	img.putpalette([ 0xFF, 0xFF, 0xFF, 0xAA, 0xAA, 0xAA, 0x55, 0x55, 0x55, 0x00, 0x00, 0x00 ])
+	img.putdata(data)
+	return img
+
+################################
+
+@pytest.mark.parametrize("seed", range(0, 20))
+def test_img2glyph(seed):
+	img = glyph_image((16, 16), seed)
+	assert builder.img2glyph(img) == img2glyph_reference(img)
+
+@pytest.mark.parametrize("seed", range(0, 20))
+def test_img2glyphs(seed):
+	img = glyph_image((160, 16), seed)
+	glyphs = builder.img2glyphs(img)
+	assert len(glyphs) == 10
+	for (i, glyph) in enumerate(glyphs):
+		assert glyph == img2glyph_reference(img.crop((i * 16, 0, i * 16 + 16, 16)))
+
+def test_img2glyphs_blank():
+	for color in ("white", "black"):
+		img = Image.new("1", (160, 16), color)
+		assert builder.img2glyphs(img) == [ img2glyph_reference(img.crop((0, 0, 16, 16))) ] * 10
+
+@pytest.mark.parametrize("seed", range(0, 10))
+def test_img2title(seed):
+	# Random pixels make every tile different, so the tile limit is reached
+	img = indexed_image(random_pixels((160, 32), [ 0, 1, 2, 3 ], seed), (160, 32))
+	assert builder.img2title(img) == img2title_reference(img)
+
+@pytest.mark.parametrize("seed", range(0, 10))
+def test_img2title_repeated_tiles(seed):
+	# Few different tiles in a random order, including empty ones
+	rng = random.Random(seed)
+	tiles = [ [ 0 ] * 64 ] + [ [ rng.randrange(0, 4) for i in range(0, 64) ] for j in range(0, 8) ]
+	order = [ rng.choice(tiles) for i in range(0, 80) ]
+	data = [ order[(y // 8) * 20 + x // 8][(y % 8) * 8 + x % 8] for y in range(0, 32) for x in range(0, 160) ]
+	img = indexed_image(data, (160, 32))
+	assert builder.img2title(img) == img2title_reference(img)
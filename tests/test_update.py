@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# 256M ROM Builder
+# Author: Lesserkuma (github.com/lesserkuma)
+#
+# Updates compilations in place.
+
+import os, sys, io, importlib, contextlib
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+builder = importlib.import_module("256m_rom_builder")
+benchmark = importlib.import_module("benchmark")
+
+################################
+
+@pytest.fixture
+def roms(tmp_path, monkeypatch):
+	# Two 8 MB ROMs, so a split compilation has more than one part
+	monkeypatch.chdir(tmp_path)
+	os.mkdir("roms")
+	for i in range(0, 2):
+		benchmark.make_rom(os.path.join("roms", "game{:02d}.gb".format(i)), 0x800000, "GAME{:02d}".format(i), seed=i)
+	benchmark.make_rom(os.path.join("roms", "game02.gb"), 0x8000, "GAME02", seed=2)
+	return builder.get_rom_sources()
+
+def build(roms, **kwargs):
+	options = builder.BuildOptions(menu=os.path.join(repo_dir, builder.default_menu_file), packing="greedy", cache=None, jobs=1, **kwargs)
+	with contextlib.redirect_stdout(io.StringIO()):
+		return builder.build_compilation(roms, options)
+
+def test_update_refuses_split_part(roms):
+	result = build(roms, file="SET.gbc", split=True)
+	assert len(result.files) > 1
+	with open(result.files[0], "rb") as f: part = f.read()
+	with pytest.raises(builder.BuildError):
+		build(roms, update=result.files[0])
+	with open(result.files[0], "rb") as f: assert f.read() == part
+
+def test_update_keeps_roms(roms):
+	result = build(roms, file="SET.gbc")
+	result = build(roms, update="SET.gbc")
+	assert result.files == [ "SET.gbc" ]
+	assert all("kept" in rom for rom in result.roms)